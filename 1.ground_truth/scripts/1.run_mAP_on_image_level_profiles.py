@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
+import sys
 
 import pandas as pd
 from copairs import map
 from copairs.matching import assign_reference_index
 
+sys.path.append("../../utils")
+from null_distribution_utils import mean_average_precision
+
 # In[2]:
 
 
@@ -55,10 +59,11 @@ activity_ap = activity_ap.query("Metadata_dose != 0.0")
 activity_ap.head()
 
 
-# In[5]:
+# In[ ]:
 
 
-activity_map = map.mean_average_precision(
+# the null distributions are cached and shared with the other mAP analyses
+activity_map = mean_average_precision(
     activity_ap, pos_sameby, null_size=1000000, threshold=0.05, seed=0
 )
 activity_map.reset_index(inplace=True)
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
+import sys
 
-import pandas as pd
+import pyarrow.parquet as pq
 
-# In[2]:
+sys.path.append("../../utils")
+from data_access_utils import combine_parquet_files
+
+# In[ ]:
 
 
 stats_path = pathlib.Path("../../data/cell_tracks_data").resolve(strict=True)
@@ -18,7 +22,7 @@ output_combined_stats_file_path = pathlib.Path(
 output_combined_stats_file_path.parent.mkdir(parents=True, exist_ok=True)
 # get the list of all files in the directory
 files = sorted(stats_path.glob("*_stats.parquet"))
-stats_df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
-stats_df.to_parquet(output_combined_stats_file_path, index=False)
-print(stats_df.shape)
-stats_df.head()
+# stream the files into one compacted file instead of concatenating them in memory
+combined_metadata = combine_parquet_files(files, output_combined_stats_file_path)
+print((combined_metadata.num_rows, combined_metadata.num_columns))
+pq.ParquetFile(output_combined_stats_file_path).read_row_group(0).to_pandas().head()
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -12,6 +13,9 @@ import pandas as pd
 import tqdm
 import umap
 
+sys.path.append("../../utils")
+from data_access_utils import get_feature_set_columns, load_profiles
+
 # In[2]:
 
 
@@ -76,28 +80,25 @@ def fit_umap_to_the_first_timepoint(
     return umap_df
 
 
-# In[3]:
+# In[ ]:
 
 
 CP_scDINO_profile_file_path = pathlib.Path(
     "../../data/CP_scDINO_features/combined_CP_scDINO_norm_fs.parquet"
 ).resolve(strict=True)
-df = pd.read_parquet(CP_scDINO_profile_file_path)
-df.head()
+# split the feature sets from the parquet schema
+feature_set_columns = get_feature_set_columns(CP_scDINO_profile_file_path)
 
 
-# In[4]:
+# In[ ]:
 
 
-metadata_columns = [x for x in df.columns if "Metadata" in x]
-scDINO_columns = [x for x in df.columns if "scDINO" in x]
-CP_columns = df.drop(columns=metadata_columns + scDINO_columns).columns
-CP_scDINO_columns = df.drop(metadata_columns, axis=1).columns
+metadata_columns = feature_set_columns["Metadata"]
 
 feature_set_dict = {
-    "scDINO": scDINO_columns,
-    "CP": CP_columns,
-    "CP_scDINO": CP_scDINO_columns,
+    "scDINO": feature_set_columns["scDINO"],
+    "CP": feature_set_columns["CP"],
+    "CP_scDINO": feature_set_columns["CP_scDINO"],
 }
 
 
@@ -114,12 +115,15 @@ umap_model = umap.UMAP(
 )
 
 
-# In[6]:
+# In[ ]:
 
 
+# the CP_scDINO columns are the union of the feature sets, so the profiles are read
+# once and each feature set is a column subset of them
+df = load_profiles(CP_scDINO_profile_file_path, feature_set="CP_scDINO")
 for feature_set_name, feature_set in tqdm.tqdm(feature_set_dict.items()):
     umap_df = fit_umap_to_the_first_timepoint(
-        df,
+        df[metadata_columns + feature_set],
         timepoint_column="Metadata_Time",
         metadata_columns=metadata_columns,
         feature_columns=feature_set,
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# This notebook benchmarks the vectorized column shuffle in `utils/shuffle_utils.py` against the per-column `np.random.permutation` loop that was used to build the shuffled baselines.
+# Synthetic single-cell tables with the width of the CP_scDINO feature set are shuffled with the metadata columns protected, as in `0.generate_mAP_scores.ipynb`.
+
+# In[ ]:
+
+
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("../../utils")
+from shuffle_utils import shuffle_columns
+
+# In[ ]:
+
+
+def generate_synthetic_profiles(
+    n_cells: int, n_features: int, seed: int = 0
+) -> pd.DataFrame:
+    """
+    Generate a synthetic single-cell profile table
+
+    Parameters
+    ----------
+    n_cells : int
+        The number of single-cell profiles
+    n_features : int
+        The number of feature columns
+    seed : int, optional
+        Random seed for reproducibility, by default 0
+
+    Returns
+    -------
+    pd.DataFrame
+        The metadata and feature columns of the single-cell profiles
+    """
+    rng = np.random.default_rng(seed)
+    profile_df = pd.DataFrame(
+        rng.normal(size=(n_cells, n_features)),
+        columns=[f"Cells_Feature_{i}_CP" for i in range(n_features)],
+    )
+    profile_df.insert(0, "Metadata_Well", rng.choice(["C-02", "C-03", "C-04"], n_cells))
+    profile_df.insert(1, "Metadata_Time", rng.integers(0, 13, n_cells).astype(float))
+    profile_df.insert(2, "Metadata_dose", rng.choice(["0.0", "0.61", "1.22"], n_cells))
+    return profile_df
+
+
+def legacy_shuffle(profile_df: pd.DataFrame, protected_columns: list) -> pd.DataFrame:
+    """
+    The original per-column np.random.permutation loop
+
+    Parameters
+    ----------
+    profile_df : pd.DataFrame
+        The profiles to shuffle
+    protected_columns : list
+        The columns that are not shuffled
+
+    Returns
+    -------
+    pd.DataFrame
+        The shuffled profiles
+    """
+    profile_df = profile_df.copy()
+    for col in profile_df.columns:
+        if col in protected_columns:
+            continue
+        profile_df[col] = np.random.permutation(profile_df[col])
+    return profile_df
+
+
+# In[ ]:
+
+
+benchmark_results_path = pathlib.Path("../results/shuffle_benchmark.parquet").resolve()
+benchmark_results_path.parent.mkdir(parents=True, exist_ok=True)
+
+n_cells_list = [1000, 10000, 50000]
+# the number of CP_scDINO features of the aggregated profiles
+n_features = 2338
+protected_columns = ["Metadata_Well", "Metadata_Time", "Metadata_dose"]
+
+
+# In[ ]:
+
+
+benchmark_results = {
+    "n_cells": [],
+    "n_features": [],
+    "vectorized_seconds": [],
+    "legacy_seconds": [],
+}
+for n_cells in n_cells_list:
+    profile_df = generate_synthetic_profiles(n_cells, n_features)
+
+    start_time = time.perf_counter()
+    _ = shuffle_columns(profile_df, protected_columns=protected_columns, seed=0)
+    vectorized_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    _ = legacy_shuffle(profile_df, protected_columns=protected_columns)
+    legacy_seconds = time.perf_counter() - start_time
+
+    benchmark_results["n_cells"].append(n_cells)
+    benchmark_results["n_features"].append(n_features)
+    benchmark_results["vectorized_seconds"].append(vectorized_seconds)
+    benchmark_results["legacy_seconds"].append(legacy_seconds)
+
+
+# In[ ]:
+
+
+benchmark_df = pd.DataFrame.from_dict(benchmark_results)
+benchmark_df["speedup"] = (
+    benchmark_df["legacy_seconds"] / benchmark_df["vectorized_seconds"]
+)
+benchmark_df.to_parquet(benchmark_results_path, index=False)
+benchmark_df
+
+
+# Check that every shuffled column is a permutation of the original column, that the protected columns are untouched and that the shuffle is reproducible with the same seed.
+
+# In[ ]:
+
+
+profile_df = generate_synthetic_profiles(1000, 100, seed=1)
+shuffled_df = shuffle_columns(profile_df, protected_columns=protected_columns, seed=0)
+
+assert shuffled_df.columns.equals(profile_df.columns)
+assert shuffled_df[protected_columns].equals(profile_df[protected_columns])
+feature_columns = [x for x in profile_df.columns if x not in protected_columns]
+assert np.array_equal(
+    np.sort(shuffled_df[feature_columns].to_numpy(), axis=0),
+    np.sort(profile_df[feature_columns].to_numpy(), axis=0),
+)
+assert shuffled_df.equals(
+    shuffle_columns(profile_df, protected_columns=protected_columns, seed=0)
+)
+# the columns are permuted independently of each other
+print(
+    f"{(shuffled_df[feature_columns] == profile_df[feature_columns]).to_numpy().mean():.4f} of the values are in place"
+)
@@ -0,0 +1,355 @@
+import importlib.metadata
+import itertools
+import multiprocessing
+import os
+import pathlib
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from copairs import map
+from copairs.matching import assign_reference_index
+from threadpoolctl import threadpool_limits
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "utils"))
+from data_access_utils import sort_by_time
+from null_distribution_utils import mean_average_precision
+from shuffle_utils import shuffle_columns
+from task_cache_utils import TaskCache, task_key
+
+# the shared profile matrices and metadata attached once in each worker process
+_shared_profiles = {}
+
+
+def _attach_shared_profiles(
+    shared_memory_name: str,
+    shape: tuple,
+    dtype: np.dtype,
+    metadata: pd.DataFrame,
+    feature_set_positions: dict,
+    map_kwargs: dict,
+) -> None:
+    """
+    Pool initializer that attaches the profile matrices in shared memory so that
+    they are not copied into every task
+
+    Parameters
+    ----------
+    shared_memory_name : str
+        The name of the shared memory block with the profile matrices
+    shape : tuple
+        The (n_variants, n_rows, n_features) shape of the profile matrices
+    dtype : np.dtype
+        The dtype of the profile matrices
+    metadata : pd.DataFrame
+        The metadata of the rows of the profile matrices
+    feature_set_positions : dict
+        Mapping of feature set name to the column positions of its features
+    map_kwargs : dict
+        The mAP parameters shared by every task
+    """
+    shared_block = shared_memory.SharedMemory(name=shared_memory_name)
+    _shared_profiles["shared_block"] = shared_block
+    _shared_profiles["profiles"] = np.ndarray(
+        shape, dtype=dtype, buffer=shared_block.buf
+    )
+    _shared_profiles["metadata"] = metadata
+    _shared_profiles["feature_set_positions"] = feature_set_positions
+    _shared_profiles["map_kwargs"] = map_kwargs
+    threadpool_limits(limits=1)
+
+
+def _run_mAP_task(task: dict) -> pd.DataFrame:
+    """
+    Calculate the mAP of one feature set, shuffle option and timepoint against
+    the reference group on the profiles attached by _attach_shared_profiles
+
+    Parameters
+    ----------
+    task : dict
+        The feature_set_name, shuffle, variant, timepoint and rows of the task
+
+    Returns
+    -------
+    pd.DataFrame
+        The mAP of each group with the Metadata_Time and Shuffle columns
+    """
+    map_kwargs = _shared_profiles["map_kwargs"]
+    reference_column_name = map_kwargs["reference_column_name"]
+    reference_group = map_kwargs["reference_group"]
+    reference_col = "Metadata_reference_index"
+
+    metadata = _shared_profiles["metadata"].iloc[task["rows"]]
+    profiles = _shared_profiles["profiles"][task["variant"], task["rows"]][
+        :, _shared_profiles["feature_set_positions"][task["feature_set_name"]]
+    ]
+    metadata = assign_reference_index(
+        metadata,
+        f"{reference_column_name} == {reference_group}",
+        reference_col=reference_col,
+        default_value=-1,
+    )
+    # drop the nans from the profiles
+    non_nan_rows = ~np.isnan(profiles).any(axis=1)
+    metadata = metadata[non_nan_rows]
+    profiles = profiles[non_nan_rows]
+
+    pos_sameby = [reference_column_name, reference_col]
+    pos_diffby = []
+    neg_sameby = []
+    neg_diffby = [reference_column_name, reference_col]
+    activity_ap = map.average_precision(
+        metadata, profiles, pos_sameby, pos_diffby, neg_sameby, neg_diffby
+    )
+    activity_ap = activity_ap.query(f"{reference_column_name} != {reference_group}")
+    # the null distributions are cached on disk and shared across processes
+    activity_map = mean_average_precision(
+        activity_ap,
+        pos_sameby,
+        null_size=map_kwargs["null_size"],
+        threshold=map_kwargs["threshold"],
+        seed=map_kwargs["seed"],
+    )
+    activity_map.reset_index(drop=True, inplace=True)
+    activity_map.insert(0, map_kwargs["time_column"], task["timepoint"])
+    activity_map.insert(1, "Shuffle", str(task["shuffle"]))
+    return activity_map
+
+
+def _task_output_file(task_output_dir: pathlib.Path, task: dict) -> pathlib.Path:
+    """
+    Get the result file of a task
+
+    Parameters
+    ----------
+    task_output_dir : pathlib.Path
+        The directory with the result of each task
+    task : dict
+        The feature_set_name, shuffle and timepoint of the task
+
+    Returns
+    -------
+    pathlib.Path
+        The path of the result file of the task
+    """
+    shuffle_status = "shuffled" if task["shuffle"] else "non_shuffled"
+    return (
+        task_output_dir
+        / f"{task['feature_set_name']}_{shuffle_status}_{task['timepoint']}.parquet"
+    )
+
+
+def run_mAP_schedule(
+    df: pd.DataFrame,
+    feature_set_dict: dict,
+    metadata_columns: list,
+    task_output_dir: pathlib.Path,
+    shuffle_options: list = (False, True),
+    seed: int = 0,
+    null_size: int = 1000000,
+    threshold: float = 0.05,
+    time_column: str = "Metadata_Time",
+    reference_column_name: str = "Metadata_dose",
+    reference_group: str = "'0.0'",
+    n_workers: int = None,
+    cache: TaskCache = None,
+    input_fingerprint: str = None,
+) -> dict[str, pd.DataFrame]:
+    """
+    Calculate the mAP of every feature set x shuffle option x timepoint task on a
+    process pool. The profiles (and their shuffled baseline) are placed in shared
+    memory once and every task reads its timepoint and feature set from them.
+    The result of each task is written to task_output_dir as soon as it finishes.
+    With a cache, the tasks whose inputs are unchanged are read from the cache
+    instead of being recomputed and are written to task_output_dir as well.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The aggregated profiles with the metadata and the features of every
+        feature set
+    feature_set_dict : dict
+        Mapping of feature set name to its feature columns
+    metadata_columns : list
+        The metadata columns used to group the profiles
+    task_output_dir : pathlib.Path
+        The directory to write the result of each task to
+    shuffle_options : list, optional
+        Whether to calculate the mAP of the profiles (False) and of the shuffled
+        baseline (True), by default (False, True)
+    seed : int, optional
+        Random seed of the shuffled baseline and the null distributions,
+        by default 0
+    null_size : int, optional
+        The number of samples in the null distribution, by default 1000000
+    threshold : float, optional
+        The p-value threshold for significance, by default 0.05
+    time_column : str, optional
+        The column name for timepoints, by default "Metadata_Time"
+    reference_column_name : str, optional
+        The column name of the reference group, by default "Metadata_dose"
+    reference_group : str, optional
+        The reference group as it is written in a query, by default "'0.0'"
+    n_workers : int, optional
+        The number of worker processes, by default None (os.cpu_count())
+    cache : TaskCache, optional
+        The cache of the task results, by default None (no caching)
+    input_fingerprint : str, optional
+        The file_fingerprint of the files df was loaded from, required with a
+        cache as it is part of the key of every task
+
+    Returns
+    -------
+    dict[str, pd.DataFrame]
+        The mAP of every shuffle option and timepoint for each feature set
+    """
+    n_workers = n_workers if n_workers is not None else os.cpu_count()
+    task_output_dir = pathlib.Path(task_output_dir)
+    task_output_dir.mkdir(parents=True, exist_ok=True)
+
+    # sort by time once so that every timepoint is a slice of the matrices
+    df, timepoint_index = sort_by_time(df, time_column=time_column)
+    feature_columns = list(dict.fromkeys(itertools.chain(*feature_set_dict.values())))
+    column_positions = {column: i for i, column in enumerate(feature_columns)}
+    feature_set_positions = {
+        feature_set_name: np.array([column_positions[x] for x in feature_set])
+        for feature_set_name, feature_set in feature_set_dict.items()
+    }
+    map_kwargs = {
+        "seed": seed,
+        "null_size": null_size,
+        "threshold": threshold,
+        "time_column": time_column,
+        "reference_column_name": reference_column_name,
+        "reference_group": reference_group,
+    }
+    tasks = [
+        {
+            "feature_set_name": feature_set_name,
+            "shuffle": shuffle,
+            "variant": variant,
+            "timepoint": timepoint,
+            "rows": timepoint_index.rows(timepoint),
+            "n_rows": timepoint_index.size(timepoint),
+        }
+        for feature_set_name, (variant, shuffle), timepoint in itertools.product(
+            feature_set_dict, enumerate(shuffle_options), timepoint_index
+        )
+    ]
+
+    results = {}
+    if cache is not None:
+        if input_fingerprint is None:
+            raise ValueError("input_fingerprint is required to cache the tasks")
+        pending_tasks = []
+        for task in tasks:
+            task["key"] = task_key(
+                input_fingerprint=input_fingerprint,
+                feature_columns=feature_set_dict[task["feature_set_name"]],
+                # the shuffled baseline is drawn over all of the feature columns
+                shuffled_columns=feature_columns if task["shuffle"] else None,
+                metadata_columns=metadata_columns,
+                timepoint=task["timepoint"],
+                shuffle=task["shuffle"],
+                copairs_version=importlib.metadata.version("copairs"),
+                **map_kwargs,
+            )
+            cached_map = cache.get(task["key"])
+            if cached_map is None:
+                pending_tasks.append(task)
+            else:
+                # the cached results are written as well, so the task directory
+                # always holds every task of the grid
+                cached_map.to_parquet(
+                    _task_output_file(task_output_dir, task), index=False
+                )
+                results[
+                    (task["feature_set_name"], task["shuffle"], task["timepoint"])
+                ] = cached_map
+        print(f"{len(tasks) - len(pending_tasks)} of {len(tasks)} tasks are cached")
+        tasks = pending_tasks
+    # schedule the largest tasks first so they do not straggle at the end
+    tasks.sort(
+        key=lambda task: len(feature_set_dict[task["feature_set_name"]])
+        * task["n_rows"],
+        reverse=True,
+    )
+
+    if len(tasks) > 0:
+        features = df[feature_columns]
+        # the columns are shuffled independently, so the shuffled baseline of
+        # every feature set is a column subset of the one shuffled baseline
+        variants = [
+            (
+                shuffle_columns(features, seed=seed).to_numpy()
+                if shuffle
+                else features.to_numpy()
+            )
+            for shuffle in shuffle_options
+        ]
+        dtype = np.result_type(*variants)
+        shape = (len(variants), *variants[0].shape)
+        shared_block = shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1)
+        )
+        try:
+            profiles = np.ndarray(shape, dtype=dtype, buffer=shared_block.buf)
+            for variant, values in enumerate(variants):
+                profiles[variant] = values
+            del variants, profiles
+            # forked workers, as the nbconverted script that calls this has no
+            # __main__ guard for spawned workers to import
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_attach_shared_profiles,
+                initargs=(
+                    shared_block.name,
+                    shape,
+                    dtype,
+                    df[metadata_columns],
+                    feature_set_positions,
+                    map_kwargs,
+                ),
+            ) as executor:
+                futures = {executor.submit(_run_mAP_task, task): task for task in tasks}
+                try:
+                    for future in as_completed(futures):
+                        task = futures[future]
+                        activity_map = future.result()
+                        activity_map.to_parquet(
+                            _task_output_file(task_output_dir, task), index=False
+                        )
+                        if cache is not None:
+                            cache.put(task["key"], activity_map)
+                        results[
+                            (
+                                task["feature_set_name"],
+                                task["shuffle"],
+                                task["timepoint"],
+                            )
+                        ] = activity_map
+                except BaseException:
+                    # cancel the queued tasks on the first failure so the shared
+                    # memory is released without running the rest of the grid
+                    executor.shutdown(cancel_futures=True)
+                    raise
+        finally:
+            shared_block.close()
+            shared_block.unlink()
+
+    # combine the tasks in the shuffle option and timepoint order
+    return {
+        feature_set_name: pd.concat(
+            [
+                results[(feature_set_name, shuffle, timepoint)]
+                for shuffle, timepoint in itertools.product(
+                    shuffle_options, timepoint_index
+                )
+            ],
+            ignore_index=True,
+        )
+        for feature_set_name in feature_set_dict
+    }
@@ -1,16 +1,20 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import itertools
 import pathlib
+import sys
 
 import numpy as np
 import pandas as pd
 
-# In[2]:
+sys.path.append("../../utils")
+from data_access_utils import load_profiles
+
+# In[ ]:
 
 
 bulk_data_file_path = pathlib.Path(
@@ -25,14 +29,18 @@ ground_truth_file_path = pathlib.Path(
 data_splits_dir = pathlib.Path("../data_splits/").resolve()
 data_splits_dir.mkdir(parents=True, exist_ok=True)
 
+# get the final_timepoint from the time column only
+timepoints = load_profiles(
+    bulk_data_file_path, feature_set=None, metadata_columns=["Metadata_Time"]
+)["Metadata_Time"]
+final_timepoint = timepoints.loc[timepoints.astype("float64").idxmax()]
+
 # Load the data
-bulk_df = pd.read_parquet(bulk_data_file_path)
+# only the row groups of the final timepoint are read for the bulk data
+bulk_df = load_profiles(bulk_data_file_path, timepoints=[final_timepoint])
 ground_truth_df = pd.read_csv(ground_truth_file_path)
 whole_image_final_df = pd.read_parquet(whole_image_final_data_file_path)
 bulk_df["Metadata_dose"] = bulk_df["Metadata_dose"].astype("float64")
-bulk_df["Metadata_Time"] = bulk_df["Metadata_Time"].astype("float64")
-# get the final_timepoint only for the bulk data
-bulk_df = bulk_df[bulk_df["Metadata_Time"] == bulk_df["Metadata_Time"].max()]
 bulk_df.drop(columns=["Metadata_Time"], inplace=True)
 bulk_df.head()
 
@@ -1,26 +1,31 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
+import os
 import pathlib
+import sys
 from typing import Tuple
 
-import joblib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
-from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import (
     explained_variance_score,
     mean_absolute_error,
     mean_squared_error,
     r2_score,
 )
-from sklearn.model_selection import KFold, cross_val_score, train_test_split
-from sklearn.multioutput import MultiOutputRegressor
+from sklearn.model_selection import KFold, train_test_split
+
+sys.path.append("../utils")
+from model_training_utils import run_training_sweep
+
+sys.path.append("../../utils")
+from shuffle_utils import shuffle_columns
 
 # ## Import the data
 
@@ -39,24 +44,13 @@ test_df = pd.read_parquet(test_data_file_path)
 train_df.head()
 
 
-# In[3]:
+# In[ ]:
 
 
 metadata_columns = [x for x in train_df.columns if "Metadata" in x]
 terminal_columns = [x for x in train_df.columns if "Terminal" in x]
 
 
-def shuffle_data(df: pd.DataFrame) -> pd.DataFrame:
-    """
-    Shuffle the data in the DataFrame.
-    """
-    df_shuffled = df.copy()
-    for col in df_shuffled.columns:
-        # permute the columns
-        df_shuffled[col] = np.random.permutation(df_shuffled[col])
-    return df_shuffled
-
-
 def x_y_data_separator(
     df: pd.DataFrame,
     y_columns: list,
@@ -88,10 +82,11 @@ def x_y_data_separator(
     return X, y, metadata
 
 
-shuffled_train_df = train_df.copy()
-shuffled_train_df = shuffle_data(shuffled_train_df)
-shuffled_test_df = test_df.copy()
-shuffled_test_df = shuffle_data(shuffled_test_df)
+# permute every column independently, the train and test sets are shuffled
+# with one seeded generator
+rng = np.random.default_rng(0)
+shuffled_train_df = shuffle_columns(train_df, seed=rng)
+shuffled_test_df = shuffle_columns(test_df, seed=rng)
 
 # split the data into train and test sets
 # train
@@ -123,7 +118,7 @@ print(
 )
 
 
-# In[4]:
+# In[ ]:
 
 
 dict_of_train_tests = {
@@ -131,129 +126,93 @@ dict_of_train_tests = {
         "X": train_X,
         "y": train_y,
         "metadata": train_metadata,
-        "model_path": [],
-        "n_estimators": [],
     },
     "train_shuffled": {
         "X": train_shuffled_X,
         "y": train_shuffled_y,
         "metadata": train_metadata_shuffled,
-        "model_path": [],
-        "n_estimators": [],
     },
     "test": {
         "X": test_X,
         "y": test_y,
         "metadata": test_metadata,
-        "model_path": [],
-        "n_estimators": [],
     },
     "test_shuffled": {
         "X": test_shuffled_X,
         "y": test_shuffled_y,
         "metadata": test_metadata_shuffled,
-        "model_path": [],
-        "n_estimators": [],
     },
 }
 
 
 # ## Model training
 
-# In[5]:
+# In[ ]:
 
 
 # set the number of trees in the forest to search for the best number of trees
 n_trees_list = [10, 100, 1000]
+# the multi-output wrapper (one forest per terminal feature) is compared against
+# a single native multi-output forest and a forest on the PCA of the terminal features
+model_types = ["multi_output_wrapper", "native", "pca"]
+# the model type that is evaluated below
+evaluated_model_type = "multi_output_wrapper"
 
 
-# In[6]:
+# In[ ]:
 
 
 # Define cross-validation strategy
 cv = KFold(n_splits=5, shuffle=True, random_state=0)  # 5-fold cross-validation
 
+training_sets = {
+    "train": (train_X, train_y),
+    "train_shuffled": (train_shuffled_X, train_shuffled_y),
+}
+# only the evaluated model type is fit on the full training set
+model_file_paths = {}
 for n_trees in n_trees_list:
-    # Initialize the multi-output regression model
-    model = MultiOutputRegressor(
-        RandomForestRegressor(
-            n_estimators=n_trees,
-            random_state=0,
-        )
-    )
-
-    # Perform cross-validation
-    cv_scores = cross_val_score(
-        model, train_X, train_y, cv=cv, scoring="r2"
-    )  # Using R^2 as the scoring metric
-    print(
-        f"Mean cross-validation scores for n_trees={n_trees}:  {np.mean(cv_scores):.4f}"
-    )
-
-    # Train the model on the full training set
-    model.fit(train_X, train_y)
-
-    # Save the trained model
-    model_file_path = pathlib.Path(
+    model_file_paths[("train", evaluated_model_type, n_trees)] = pathlib.Path(
         f"../models/multi_regression_model_ntrees_{n_trees}.joblib"
     ).resolve()
-    joblib.dump(model, model_file_path)
-    dict_of_train_tests["train"]["model_path"].append(model_file_path)
-    dict_of_train_tests["test"]["model_path"].append(model_file_path)
-    dict_of_train_tests["train"]["n_estimators"].append(n_trees)
-    dict_of_train_tests["test"]["n_estimators"].append(n_trees)
-
-    # Repeat for shuffled data
-    shuffled_model = MultiOutputRegressor(
-        RandomForestRegressor(
-            n_estimators=n_trees,
-            random_state=0,
-            n_jobs=-1,
-        )
-    )
-
-    # Perform cross-validation on shuffled data
-    shuffled_cv_scores = cross_val_score(
-        shuffled_model, train_shuffled_X, train_shuffled_y, cv=cv, scoring="r2"
-    )
-    print(
-        f"Mean cross-validation scores for shuffled data with n_trees={n_trees}: {np.mean(shuffled_cv_scores):.4f}"
-    )
-
-    # Train the shuffled model on the full shuffled training set
-    shuffled_model.fit(train_shuffled_X, train_shuffled_y)
-
-    # Save the shuffled model
-    shuffled_model_file_path = pathlib.Path(
+    model_file_paths[("train_shuffled", evaluated_model_type, n_trees)] = pathlib.Path(
         f"../models/shuffled_multi_regression_model_ntrees_{n_trees}.joblib"
     ).resolve()
-    joblib.dump(shuffled_model, shuffled_model_file_path)
-    dict_of_train_tests["train_shuffled"]["model_path"].append(shuffled_model_file_path)
-    dict_of_train_tests["test_shuffled"]["model_path"].append(shuffled_model_file_path)
-    dict_of_train_tests["train_shuffled"]["n_estimators"].append(n_trees)
-    dict_of_train_tests["test_shuffled"]["n_estimators"].append(n_trees)
-
+# the data splits that are evaluated with the models fit on each training set
+evaluated_splits = {
+    "train": ["train", "test"],
+    "train_shuffled": ["train_shuffled", "test_shuffled"],
+}
 
-# ## Model Evaluation
 
-# In[7]:
+def evaluate_model(
+    model_key: tuple, model
+) -> dict[str, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Evaluate a model fit on a full training set on the data splits of that
+    training set
 
+    Parameters
+    ----------
+    model_key : tuple
+        The (training set name, model type, n_trees) of the model
+    model
+        The fitted model
 
-output_dict_of_dfs = {"prediction_stats_df": [], "predictions_df": []}
-for split in dict_of_train_tests.keys():
-    if "shuffle" in split:
-        shuffle = True
-    else:
-        shuffle = False
-    X = dict_of_train_tests[split]["X"]
-    y = dict_of_train_tests[split]["y"]
-    metadata = dict_of_train_tests[split]["metadata"]
-    for n_tree_model in enumerate(dict_of_train_tests[split]["model_path"]):
-        model = joblib.load(dict_of_train_tests[split]["model_path"][n_tree_model[0]])
-
-        n_estimators = dict_of_train_tests[split]["n_estimators"][n_tree_model[0]]
-
-        # make predictions on the training data
+    Returns
+    -------
+    dict[str, Tuple[pd.DataFrame, pd.DataFrame]]
+        The prediction stats and the predictions of each evaluated data split
+    """
+    training_set, _, n_estimators = model_key
+    evaluations = {}
+    for split in evaluated_splits[training_set]:
+        shuffle = "shuffle" in split
+        X = dict_of_train_tests[split]["X"]
+        y = dict_of_train_tests[split]["y"]
+        metadata = dict_of_train_tests[split]["metadata"]
+
+        # make predictions on the data split
         y_pred = model.predict(X)
         # calculate the mean absolute error
         mae = mean_absolute_error(y, y_pred)
@@ -271,7 +230,6 @@ for split in dict_of_train_tests.keys():
         prediction_stats_df["data_split"] = split
         prediction_stats_df["shuffled"] = shuffle
         prediction_stats_df["n_estimators"] = n_estimators
-        output_dict_of_dfs["prediction_stats_df"].append(prediction_stats_df)
 
         predictions_df = pd.DataFrame(y_pred, columns=terminal_columns)
         predictions_df.insert(0, "Metadata_data_split", split)
@@ -279,16 +237,60 @@ for split in dict_of_train_tests.keys():
         # add the metadata columns to the predictions_df
         for col in metadata.columns:
             predictions_df.insert(2, col, metadata[col])
-        output_dict_of_dfs["predictions_df"].append(predictions_df)
+        evaluations[split] = (prediction_stats_df, predictions_df)
+    return evaluations
+
+
+# run every (training set x model type x fold) fit on one pool of single threaded
+# fits, growing each forest through n_trees_list with warm start instead of refitting
+# it from scratch for each number of trees, then grow the full training set models
+# the same way with all cores, each size is evaluated in memory as soon as it is fit
+sweep_df, model_evaluations = run_training_sweep(
+    training_sets=training_sets,
+    n_trees_list=n_trees_list,
+    cv=cv,
+    model_file_paths=model_file_paths,
+    model_types=model_types,
+    n_workers=os.cpu_count(),
+    evaluate_full_model=evaluate_model,
+    warm_start=True,
+)
+for (training_set, model_type, n_trees), cv_scores in sweep_df.query(
+    "fold != 'full'"
+).groupby(["training_set", "model_type", "n_trees"])["r2"]:
+    print(
+        f"Mean cross-validation scores for {training_set} {model_type} with n_trees={n_trees}: {np.mean(cv_scores):.4f}"
+    )
+
+# compare the accuracy and fit/predict time of the model types
+sweep_df.query("fold != 'full'").groupby(["training_set", "model_type", "n_trees"])[
+    ["r2", "fit_time_s", "predict_time_s"]
+].mean()
 
 
+# ## Model Evaluation
+
+# In[ ]:
+
+
+output_dict_of_dfs = {"prediction_stats_df": [], "predictions_df": []}
+# collect the evaluations by data split and number of trees
+for split in dict_of_train_tests.keys():
+    training_set = "train_shuffled" if "shuffle" in split else "train"
+    for n_trees in n_trees_list:
+        prediction_stats_df, predictions_df = model_evaluations[
+            (training_set, evaluated_model_type, n_trees)
+        ][split]
+        output_dict_of_dfs["prediction_stats_df"].append(prediction_stats_df)
+        output_dict_of_dfs["predictions_df"].append(predictions_df)
+
 prediction_stats_df = pd.concat(output_dict_of_dfs["prediction_stats_df"], axis=0)
 predictions_df = pd.concat(output_dict_of_dfs["predictions_df"], axis=0)
 print(prediction_stats_df.shape)
 print(predictions_df.shape)
 
 
-# In[8]:
+# In[ ]:
 
 
 # save the final training results
@@ -296,8 +298,24 @@ prediction_stats_df_file_path = results_dir / "prediction_stats_df.parquet"
 prediction_stats_df.to_parquet(prediction_stats_df_file_path, index=False)
 predictions_df_file_path = results_dir / "predictions_df_final_timepoint.parquet"
 predictions_df.to_parquet(predictions_df_file_path, index=False)
+# save the R2, wall time and peak memory of every fit of the training sweep
+sweep_df_file_path = results_dir / "training_sweep_df.parquet"
+sweep_df.astype({"model_file_path": str}).to_parquet(sweep_df_file_path, index=False)
 # write the terminal column names to a file
 terminal_columns_file_path = results_dir / "terminal_columns.txt"
 with open(terminal_columns_file_path, "w") as f:
     for col in terminal_columns:
         f.write(f"{col}\n")
+
+# 2.evaluate_model predicts with the models with the best cross-validated number of trees
+best_n_trees = (
+    sweep_df.query(
+        "training_set == 'train' and model_type == @evaluated_model_type and fold != 'full'"
+    )
+    .groupby("n_trees")["r2"]
+    .mean()
+    .idxmax()
+)
+print(f"The best {evaluated_model_type} models have n_trees={best_n_trees}")
+best_n_trees_file_path = results_dir / "best_n_trees.txt"
+best_n_trees_file_path.write_text(f"{best_n_trees}\n")
@@ -1,27 +1,38 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
+import sys
 
 import joblib
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-# In[2]:
+sys.path.append("../../utils")
+from data_access_utils import get_feature_set_columns, iter_profile_batches
+from shuffle_utils import shuffle_columns
+
+# In[ ]:
 
 
 # load the training data
 profile_file_dir = pathlib.Path(
     "../../data/CP_scDINO_features/combined_CP_scDINO_norm_fs_aggregated.parquet"
 ).resolve(strict=True)
-model_file_dir = pathlib.Path("../models/multi_regression_model.joblib").resolve(
-    strict=True
+# the models with the best cross-validated number of trees from 1.train_model
+best_n_trees = int(
+    pathlib.Path("../results/best_n_trees.txt").resolve(strict=True).read_text()
 )
+model_file_dir = pathlib.Path(
+    f"../models/multi_regression_model_ntrees_{best_n_trees}.joblib"
+).resolve(strict=True)
 shuffled_model_file_dir = pathlib.Path(
-    "../models/shuffled_multi_regression_model.joblib"
+    f"../models/shuffled_multi_regression_model_ntrees_{best_n_trees}.joblib"
 ).resolve(strict=True)
 terminal_column_names = pathlib.Path("../results/terminal_columns.txt").resolve(
     strict=True
@@ -34,63 +45,88 @@ terminal_column_names = [
 ]
 results_dir = pathlib.Path("../results/").resolve()
 results_dir.mkdir(parents=True, exist_ok=True)
-profile_df = pd.read_parquet(profile_file_dir)
-print(profile_df.shape)
-profile_df.head()
+# seed of the feature shuffles of the shuffled predictions
+shuffle_seed = 0
 
 
-# ## Get the non-shuffled predictions
+# ## Get the non-shuffled and shuffled predictions
 
-# In[3]:
+# In[ ]:
 
 
-# load the model
+# load the models
 model = joblib.load(model_file_dir)
 shuffled_model = joblib.load(shuffled_model_file_dir)
 
-metadata_columns = [x for x in profile_df.columns if "Metadata_" in x]
-# remove metadata columns
-features = profile_df.drop(columns=metadata_columns)
-metadata_df = profile_df[metadata_columns]
-# predict the terminal feature space
-predictions = model.predict(features)
-predictions_df = pd.DataFrame(predictions, columns=terminal_column_names)
-# insert the metadata columns
-for col in metadata_columns:
-    predictions_df.insert(0, col, metadata_df[col])
-predictions_df["shuffled"] = False
-
 
-# ## Get the shuffled predictions
+def predict_terminal_profiles(
+    model, features: pd.DataFrame, metadata_df: pd.DataFrame, shuffled: bool
+) -> pd.DataFrame:
+    """
+    Predict the terminal profiles of a batch of profiles and add back the metadata
+    """
+    predictions_df = pd.DataFrame(
+        model.predict(features), columns=terminal_column_names
+    )
+    # insert the metadata columns
+    for col in metadata_df.columns:
+        predictions_df.insert(0, col, metadata_df[col].to_numpy())
+    predictions_df["shuffled"] = shuffled
+    return predictions_df
 
-# In[4]:
-
-
-# load the model
-shuffled_model = joblib.load(shuffled_model_file_dir)
 
-metadata_columns = [x for x in profile_df.columns if "Metadata_" in x]
-shuffled_profile_df = profile_df.copy()
-for col in shuffled_profile_df.columns:
-    shuffled_profile_df[col] = np.random.permutation(shuffled_profile_df[col])
-# remove metadata columns
-features = shuffled_profile_df.drop(columns=metadata_columns)
-metadata_df = profile_df[metadata_columns]
+# In[ ]:
 
 
-# predict the terminal feature space
-predictions = shuffled_model.predict(features)
-shuffled_predictions_df = pd.DataFrame(predictions, columns=terminal_column_names)
-# insert the metadata columns
-for col in metadata_columns:
-    shuffled_predictions_df.insert(0, col, metadata_df[col])
-shuffled_predictions_df["shuffled"] = True
-
-
-# In[5]:
-
-
-final_predictions_df = pd.concat([predictions_df, shuffled_predictions_df], axis=0)
-# save the predictions
-final_predictions_df.to_parquet(predictions_save_path, index=False)
-final_predictions_df
+# predict one timepoint at a time and append the predictions to the parquet file
+# so that only one timepoint of profiles and predictions is in memory at a time
+metadata_columns = [
+    x for x in get_feature_set_columns(profile_file_dir)["Metadata"] if "Metadata_" in x
+]
+# the schema of the predictions is built from the profile file schema instead of
+# the first timepoint, so metadata that is null or typed differently in a
+# timepoint is still written, predict_terminal_profiles inserts the metadata
+# columns in reverse order
+profile_schema = pq.read_schema(profile_file_dir)
+predictions_schema = pa.schema(
+    [profile_schema.field(col) for col in reversed(metadata_columns)]
+    + [pa.field(col, pa.float64()) for col in terminal_column_names]
+    + [pa.field("shuffled", pa.bool_())]
+)
+n_predictions = 0
+# the writer is closed even if a prediction fails and writes an empty file when
+# there are no profiles
+with pq.ParquetWriter(predictions_save_path, predictions_schema) as writer:
+    for batch_index, (timepoint, profile_df) in enumerate(
+        iter_profile_batches(profile_file_dir, feature_set="CP_scDINO")
+    ):
+        metadata_df = profile_df[metadata_columns]
+        features = profile_df.drop(columns=metadata_columns)
+        # shuffle each feature independently within the timepoint, seeded per
+        # timepoint so the shuffle of a timepoint does not depend on the others
+        rng = np.random.default_rng([shuffle_seed, batch_index])
+        shuffled_features = shuffle_columns(features, seed=rng)
+
+        batch_predictions_df = pd.concat(
+            [
+                predict_terminal_profiles(model, features, metadata_df, shuffled=False),
+                predict_terminal_profiles(
+                    shuffled_model, shuffled_features, metadata_df, shuffled=True
+                ),
+            ],
+            axis=0,
+        )
+        writer.write_table(
+            pa.Table.from_pandas(
+                batch_predictions_df, schema=predictions_schema, preserve_index=False
+            )
+        )
+        n_predictions += len(batch_predictions_df)
+        print(f"Predicted timepoint {timepoint}: {len(profile_df)} profiles")
+print(f"Wrote {n_predictions} predictions to {predictions_save_path}")
+
+
+# In[ ]:
+
+
+pq.ParquetFile(predictions_save_path).metadata
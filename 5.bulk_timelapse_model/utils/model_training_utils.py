@@ -0,0 +1,457 @@
+import ctypes
+import ctypes.util
+import gc
+import itertools
+import multiprocessing
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.compose import TransformedTargetRegressor
+from sklearn.decomposition import PCA
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import r2_score
+from sklearn.model_selection import KFold
+from sklearn.multioutput import MultiOutputRegressor
+from threadpoolctl import threadpool_limits
+
+# training sets attached once in each worker process
+_training_sets = {}
+
+# the compression level of the model artifacts of the full training set fits
+MODEL_COMPRESSION = 3
+
+MODEL_TYPES = ("multi_output_wrapper", "native", "pca")
+
+
+def _current_rss_bytes() -> int:
+    """
+    Get the resident memory of this process from /proc (Linux only)
+    """
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _release_free_memory() -> None:
+    """
+    Collect garbage and return the memory that glibc keeps after free to the
+    operating system, so that the resident memory is not inflated by earlier fits
+    """
+    gc.collect()
+    libc_path = ctypes.util.find_library("c")
+    if libc_path is not None:
+        libc = ctypes.CDLL(libc_path)
+        if hasattr(libc, "malloc_trim"):
+            libc.malloc_trim(0)
+
+
+class _PeakRSSSampler:
+    """
+    Context manager that samples the resident memory of the process on a
+    background thread and keeps the peak above the resident memory on entry.
+    ru_maxrss is the high-water mark of the whole process lifetime, so in a
+    worker that already ran a larger fit it does not measure the current one.
+
+    Parameters
+    ----------
+    interval_s : float, optional
+        The time between two samples in seconds, by default 0.01
+    """
+
+    def __init__(self, interval_s: float = 0.01):
+        self.interval_s = interval_s
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self.peak_bytes = max(
+                self.peak_bytes, _current_rss_bytes() - self._baseline_bytes
+            )
+
+    def __enter__(self) -> "_PeakRSSSampler":
+        _release_free_memory()
+        self._baseline_bytes = _current_rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+        # the last sample, so fits shorter than one interval are measured as well
+        self.peak_bytes = max(
+            self.peak_bytes, _current_rss_bytes() - self._baseline_bytes
+        )
+
+
+def make_model(
+    n_trees: int,
+    random_state: int = 0,
+    model_type: str = "multi_output_wrapper",
+    pca_n_components: float = 0.95,
+    n_jobs: int = 1,
+    warm_start: bool = False,
+) -> MultiOutputRegressor | RandomForestRegressor | TransformedTargetRegressor:
+    """
+    Build the multi-output random forest model of the bulk timelapse model.
+    The forest is single threaded by default as the sweep runs the fits in
+    parallel.
+
+    Parameters
+    ----------
+    n_trees : int
+        The number of trees in the forest
+    random_state : int, optional
+        Random seed for reproducibility, by default 0
+    model_type : str, optional
+        One of MODEL_TYPES, by default "multi_output_wrapper":
+            "multi_output_wrapper" trains one forest per terminal feature
+            "native" trains a single forest that predicts all terminal features
+            "pca" trains a single forest that predicts the PCA components of the
+            terminal features and inverts the PCA for the predictions
+    pca_n_components : float, optional
+        The PCA n_components of the "pca" model, by default 0.95 which keeps the
+        components that explain 95% of the variance of the terminal features
+    n_jobs : int, optional
+        The number of threads that build the trees of each forest, by default 1
+    warm_start : bool, optional
+        Whether the forests keep their trees when refit with more trees, see
+        grow_model, by default False
+
+    Returns
+    -------
+    MultiOutputRegressor | RandomForestRegressor | TransformedTargetRegressor
+        The unfitted model
+    """
+    forest = RandomForestRegressor(
+        n_estimators=n_trees,
+        random_state=random_state,
+        n_jobs=n_jobs,
+        warm_start=warm_start,
+    )
+    if model_type == "multi_output_wrapper":
+        return MultiOutputRegressor(forest)
+    if model_type == "native":
+        return forest
+    if model_type == "pca":
+        return TransformedTargetRegressor(
+            regressor=forest,
+            transformer=PCA(n_components=pca_n_components),
+            check_inverse=False,
+        )
+    raise ValueError(f"model_type must be one of {MODEL_TYPES}, got {model_type}")
+
+
+def _attach_training_sets(training_sets: dict) -> None:
+    """
+    Pool initializer that stores the training sets in each worker process and
+    limits the native thread pools to a single thread so the workers do not
+    oversubscribe the cores
+
+    Parameters
+    ----------
+    training_sets : dict
+        Mapping of training set name to (X, y)
+    """
+    _training_sets.update(training_sets)
+    threadpool_limits(limits=1)
+
+
+def grow_model(
+    model: MultiOutputRegressor | RandomForestRegressor | TransformedTargetRegressor,
+    n_trees: int,
+    X: pd.DataFrame,
+    y: pd.DataFrame,
+) -> None:
+    """
+    Grow the forests of a model fit with warm_start=True to n_trees, only training
+    the new trees. The forests are the same as forests fit with n_trees from
+    scratch as the random forest skips the seeds of the existing trees.
+
+    Parameters
+    ----------
+    model : MultiOutputRegressor | RandomForestRegressor | TransformedTargetRegressor
+        A model from make_model(..., warm_start=True) that is already fit on X, y
+    n_trees : int
+        The number of trees to grow each forest to
+    X : pd.DataFrame
+        The data the model was fit on
+    y : pd.DataFrame
+        The targets the model was fit on
+    """
+    if isinstance(model, MultiOutputRegressor):
+        # the wrapper clones its forests when refit, so grow the fitted ones
+        for i, forest in enumerate(model.estimators_):
+            forest.set_params(n_estimators=n_trees)
+            forest.fit(X, y.iloc[:, i].to_numpy())
+    elif isinstance(model, TransformedTargetRegressor):
+        # the regressor is fit on the targets transformed by the fitted PCA
+        y_transformed = model.transformer_.transform(y.to_numpy())
+        if y_transformed.ndim == 2 and y_transformed.shape[1] == 1:
+            y_transformed = y_transformed.squeeze(axis=1)
+        model.regressor_.set_params(n_estimators=n_trees)
+        model.regressor_.fit(X, y_transformed)
+    else:
+        model.set_params(n_estimators=n_trees)
+        model.fit(X, y)
+
+
+def _run_fit(
+    task: dict, training_sets: dict = None, evaluate_full_model: Callable = None
+) -> tuple[list[dict], dict]:
+    """
+    Fit the models of one training set, model type and fold (or the full training
+    set) of the sweep for each of the task's number of trees. With warm start the
+    forest is grown from one number of trees to the next instead of being refit
+    from scratch.
+
+    Parameters
+    ----------
+    task : dict
+        The training set name, model_type, n_trees_list, n_jobs, fold, train and
+        test row indices, random_state, warm_start and, for the full fits, the
+        model_file_paths to write per number of trees
+    training_sets : dict, optional
+        Mapping of training set name to (X, y), by default None which uses the
+        training sets attached to the worker process
+    evaluate_full_model : Callable, optional
+        Called with the (training set name, model type, n_trees) key and the
+        model of each number of trees that has a model file path, by default
+        None (no evaluation)
+
+    Returns
+    -------
+    tuple[list[dict], dict]
+        The sweep record of each number of trees with the R2 score and predict
+        wall time on the held out fold (NaN for the full fits), the fit wall time
+        and the peak resident memory of the fit above the resident memory before
+        it (of the new trees only with warm start), and the return value of
+        evaluate_full_model by key
+    """
+    training_sets = training_sets if training_sets is not None else _training_sets
+    X, y = training_sets[task["training_set"]]
+    train_X = X.iloc[task["train_index"]]
+    train_y = y.iloc[task["train_index"]]
+
+    records = []
+    evaluations = {}
+    model = None
+    for n_trees in task["n_trees_list"]:
+        # the memory of the fit is measured above the resident memory before it,
+        # so it is not the high-water mark of earlier fits in the same worker
+        with _PeakRSSSampler() as peak_rss:
+            start_time = time.perf_counter()
+            if model is None or not task["warm_start"]:
+                model = make_model(
+                    n_trees,
+                    random_state=task["random_state"],
+                    model_type=task["model_type"],
+                    n_jobs=task["n_jobs"],
+                    warm_start=task["warm_start"],
+                )
+                model.fit(train_X, train_y)
+            else:
+                grow_model(model, n_trees, train_X, train_y)
+            fit_time = time.perf_counter() - start_time
+
+        r2 = np.nan
+        predict_time = np.nan
+        if task["test_index"] is not None:
+            start_time = time.perf_counter()
+            y_pred = model.predict(X.iloc[task["test_index"]])
+            predict_time = time.perf_counter() - start_time
+            # same score as cross_val_score with scoring="r2"
+            r2 = r2_score(y.iloc[task["test_index"]], y_pred)
+        model_file_path = task["model_file_paths"].get(n_trees)
+        if model_file_path is not None:
+            joblib.dump(model, model_file_path, compress=MODEL_COMPRESSION)
+            if evaluate_full_model is not None:
+                # evaluated before the model grows any further
+                key = (task["training_set"], task["model_type"], n_trees)
+                evaluations[key] = evaluate_full_model(key, model)
+
+        records.append(
+            {
+                "training_set": task["training_set"],
+                "model_type": task["model_type"],
+                "n_trees": n_trees,
+                "fold": task["fold"],
+                "r2": r2,
+                "fit_time_s": fit_time,
+                "predict_time_s": predict_time,
+                "peak_fit_rss_mb": peak_rss.peak_bytes / 1024**2,
+                "model_file_path": model_file_path,
+            }
+        )
+    return records, evaluations
+
+
+def _run_cv_fit(task: dict) -> list[dict]:
+    """
+    Fit the cross-validation models of a task in a worker process and only
+    return their sweep records, so the models are not sent back to the parent
+    process
+
+    Parameters
+    ----------
+    task : dict
+        The task of _run_fit
+
+    Returns
+    -------
+    list[dict]
+        The sweep record of each number of trees
+    """
+    return _run_fit(task)[0]
+
+
+def run_training_sweep(
+    training_sets: dict,
+    n_trees_list: list,
+    cv: KFold,
+    model_file_paths: dict,
+    model_types: list = None,
+    n_workers: int = None,
+    random_state: int = 0,
+    evaluate_full_model: Callable = None,
+    warm_start: bool = True,
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Cross-validate and fit the model for every training set, model type and
+    number of trees. Every (training set x model type x fold) task is scheduled
+    on a single process pool of single threaded fits, so the total number of
+    cores used is n_workers. With warm start each task grows one forest through
+    the sorted n_trees_list, so e.g. 10 -> 100 -> 1000 trees trains 1000 instead
+    of 1110 trees and gives the same forests as fitting each from scratch.
+    The models on the full training set are then grown the same way in this
+    process with n_workers threads per forest, so they are not sent back from
+    the worker processes. The model of each number of trees is written and
+    handed to evaluate_full_model before it grows further, so at most one of
+    them is in memory at a time.
+
+    Parameters
+    ----------
+    training_sets : dict
+        Mapping of training set name (e.g. "train", "train_shuffled") to (X, y)
+    n_trees_list : list
+        The number of trees in the forest to sweep over
+    cv : KFold
+        The cross-validation strategy
+    model_file_paths : dict
+        Mapping of (training set name, model type, n_trees) to the path to write
+        the model fit on the full training set to, compressed with
+        MODEL_COMPRESSION. Combinations that are not in the mapping are only
+        cross-validated.
+    model_types : list, optional
+        The model types of make_model to sweep over, by default None which only
+        sweeps the "multi_output_wrapper" model
+    n_workers : int, optional
+        The number of cores to use, by default None which uses all of them
+    random_state : int, optional
+        Random seed of the models, by default 0
+    evaluate_full_model : Callable, optional
+        Called with the (training set name, model type, n_trees) key and the
+        model fit on the full training set, by default None (no evaluation)
+    warm_start : bool, optional
+        Whether to grow the forests through n_trees_list instead of fitting one
+        model per number of trees, by default True
+
+    Returns
+    -------
+    tuple[pd.DataFrame, dict]
+        One row per fit with the training_set, model_type, n_trees, fold ("full"
+        for the fit on the full training set), r2, fit_time_s, predict_time_s,
+        peak_fit_rss_mb and model_file_path, and the return value of
+        evaluate_full_model for each (training set name, model type, n_trees) of
+        the full training set models
+    """
+    n_workers = n_workers if n_workers is not None else os.cpu_count()
+    model_types = model_types if model_types is not None else ["multi_output_wrapper"]
+    # with warm start a task grows its forest through all of the numbers of trees
+    n_trees_lists = (
+        [sorted(n_trees_list)] if warm_start else [[x] for x in n_trees_list]
+    )
+    tasks = []
+    full_tasks = []
+    for training_set, (X, y) in training_sets.items():
+        for model_type, task_n_trees_list in itertools.product(
+            model_types, n_trees_lists
+        ):
+            task = {
+                "training_set": training_set,
+                "model_type": model_type,
+                "random_state": random_state,
+                "warm_start": warm_start,
+            }
+            for fold, (train_index, test_index) in enumerate(cv.split(X, y)):
+                tasks.append(
+                    {
+                        **task,
+                        "n_trees_list": task_n_trees_list,
+                        "fold": fold,
+                        "train_index": train_index,
+                        "test_index": test_index,
+                        "n_jobs": 1,
+                        "model_file_paths": {},
+                    }
+                )
+            full_model_file_paths = {
+                n_trees: pathlib.Path(
+                    model_file_paths[(training_set, model_type, n_trees)]
+                )
+                for n_trees in task_n_trees_list
+                if (training_set, model_type, n_trees) in model_file_paths
+            }
+            if len(full_model_file_paths) == 0:
+                continue
+            for model_file_path in full_model_file_paths.values():
+                model_file_path.parent.mkdir(parents=True, exist_ok=True)
+            full_tasks.append(
+                {
+                    **task,
+                    # the forest is only grown up to the largest model to write
+                    "n_trees_list": [
+                        x for x in task_n_trees_list if x <= max(full_model_file_paths)
+                    ],
+                    "fold": "full",
+                    "train_index": np.arange(len(X)),
+                    "test_index": None,
+                    "n_jobs": n_workers,
+                    "model_file_paths": full_model_file_paths,
+                }
+            )
+    # schedule the largest forests first so they do not straggle at the end
+    tasks.sort(key=lambda task: max(task["n_trees_list"]), reverse=True)
+
+    records = []
+    # the workers are forked explicitly, spawned workers would re-import the
+    # training script, which has no __main__ guard
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_attach_training_sets,
+        initargs=(training_sets,),
+    ) as executor:
+        futures = [executor.submit(_run_cv_fit, task) for task in tasks]
+        for future in as_completed(futures):
+            records.extend(future.result())
+
+    full_model_evaluations = {}
+    for task in full_tasks:
+        task_records, evaluations = _run_fit(task, training_sets, evaluate_full_model)
+        records.extend(task_records)
+        full_model_evaluations.update(evaluations)
+
+    sweep_df = pd.DataFrame(records)
+    sweep_df["fold"] = sweep_df["fold"].astype(str)
+    sweep_df = sweep_df.sort_values(
+        ["training_set", "model_type", "n_trees", "fold"]
+    ).reset_index(drop=True)
+    return sweep_df, full_model_evaluations
@@ -47,74 +47,73 @@
 # The null hypothesis is that all factors for every feature will have a beta coeffienct of 0. This would imply that the factors do not contribute to the morphology feature.
 # The alternative hypothesis is that at least one factor for individual features will have a beta coeffienct > 0. This would imply that the factors do contribute to the morphology feature.
 
-# In[1]:
+# In[ ]:
 
 
+import argparse
 import pathlib
+import sys
 import warnings
 
-import joblib
 import numpy as np
 import pandas as pd
-import statsmodels
-import statsmodels.api as sm
-import tqdm
 from statsmodels.stats.multitest import multipletests
 
-warnings.filterwarnings("ignore")
-
-
-# In[2]:
+sys.path.append("../../utils")
+from data_access_utils import get_feature_set_columns, load_profiles
+from feature_name_utils import CHANNEL_LABELS, parse_feature_names
 
+sys.path.append("../utils")
+from linear_model_utils import (
+    fit_mass_univariate_ols,
+    permutation_test_mass_univariate_ols,
+    save_model_results,
+)
 
-def fit_linear_model(
-    X: np.ndarray,
-    y: np.ndarray,
-    feature: str,
-    write: bool = False,
-) -> statsmodels.regression.linear_model.RegressionResultsWrapper:
-    """
-    Fit a linear model to the data and save the model to a file.
-
-    Parameters
-    ----------
-    X : np.ndarray
-        The input data to fit on. Should be numeric.
-    y : np.ndarray
-        The target data to fit on. Should be numeric.
-    feature : str
-        The feature name that is used from y to fit the model.
-    shuffle : bool
-        Whether to shuffle the data before fitting the model.
+warnings.filterwarnings("ignore")
 
-    Returns
-    -------
-    model : statsmodels.regression.linear_model.RegressionResultsWrapper
-        The fitted model.
-    """
-    # Ensure X and y are numeric
-    X = X.apply(pd.to_numeric, errors="coerce")
-    y = pd.to_numeric(y, errors="coerce")
+# check if in a jupyter notebook
+try:
+    cfg = get_ipython().config
+    in_notebook = True
+except NameError:
+    in_notebook = False
 
-    # Drop rows with missing values and match the indices in the y series
-    X = X.dropna()
-    y = y.loc[X.index]
 
-    # Add a constant for the intercept
-    X = sm.add_constant(X)
+# In[ ]:
 
-    # Fit the model
-    model = sm.OLS(y, X).fit()
-    if write:
-        # write the model to a file joblib
-        joblib_path = pathlib.Path(f"../linear_models/lm_{feature}.joblib").resolve()
-        joblib_path.parent.mkdir(parents=True, exist_ok=True)
-        joblib.dump(model, joblib_path)
 
-    return model
+if not in_notebook:
+    # setup the argument parser
+    parser = argparse.ArgumentParser(description="Fit the linear models")
+    parser.add_argument(
+        "--permutation_test",
+        action="store_true",
+        help="Run a permutation test of the betas of every feature",
+    )
+    parser.add_argument(
+        "--n_permutations",
+        type=int,
+        default=1000,
+        help="The number of permutations of the permutation test",
+    )
+    parser.add_argument(
+        "--save_null_betas",
+        action="store_true",
+        help="Write the null distribution of the betas of the permutation test",
+    )
+    # parse the arguments
+    args = parser.parse_args()
+    permutation_test = args.permutation_test
+    n_permutations = args.n_permutations
+    save_null_betas = args.save_null_betas
+else:
+    permutation_test = False
+    n_permutations = 1000
+    save_null_betas = False
 
 
-# In[3]:
+# In[ ]:
 
 
 agg_profile_file_path = pathlib.Path(
@@ -126,17 +125,27 @@ all_features_beta_df_path = pathlib.Path(
 ).resolve()
 all_features_beta_df_path.parent.mkdir(parents=True, exist_ok=True)
 
-df = pd.read_parquet(agg_profile_file_path)
+# only the metadata columns used in the linear model are read with the features
+df = load_profiles(
+    agg_profile_file_path,
+    feature_set="CP_scDINO",
+    metadata_columns=[
+        "Metadata_Time",
+        "Metadata_number_of_singlecells",
+        "Metadata_dose",
+    ],
+)
 df.head()
 
 
-# In[4]:
+# In[ ]:
 
 
+feature_set_columns = get_feature_set_columns(agg_profile_file_path)
 # get the metadata features
-metadata_columns = [x for x in df.columns if "Metadata" in x]
+metadata_columns = feature_set_columns["Metadata"]
 # get the features
-feature_columns = [x for x in df.columns if "Metadata" not in x]
+feature_columns = feature_set_columns["CP_scDINO"]
 time_column = "Metadata_Time"
 single_cells_count_column = "Metadata_number_of_singlecells"
 dose_column = "Metadata_dose"
@@ -153,25 +162,7 @@ df[interaction_column1] = df["Metadata_number_of_singlecells"] * df["Metadata_Ti
 df[interaction_column2] = df["Metadata_Time"] * df["Metadata_dose"]
 
 
-# In[5]:
-
-
-coefficient_names = {
-    "beta": [],
-    "p_value": [],
-    "variate": [],
-    "r2": [],
-    "feature": [],
-}
-
-
-# In[6]:
-
-
-model_dict = {}
-
-
-# In[7]:
+# In[ ]:
 
 
 X = df[
@@ -183,167 +174,93 @@ X = df[
         interaction_column2,
     ]
 ]
-for feature in tqdm.tqdm(feature_columns):
-    y = df[feature]
-    model = fit_linear_model(
+# the design is the same for every feature so all features are fit in one call
+model_results = fit_mass_univariate_ols(X, df[feature_columns])
+
+
+# In[ ]:
+
+
+# one row per feature and variate in the order of the model coefficients
+n_features, n_variates = model_results["params"].shape
+coefficient_names = {
+    "beta": model_results["params"].to_numpy().ravel(),
+    "p_value": model_results["pvalues"].to_numpy().ravel(),
+    "variate": np.tile(model_results["params"].columns, n_features),
+    "r2": np.repeat(model_results["rsquared"].to_numpy(), n_variates),
+    "feature": np.repeat(model_results["params"].index, n_variates),
+}
+if permutation_test:
+    # shuffled baseline of the betas: the responses are permuted relative to the
+    # design and every feature is refit for each permutation, the constant is not
+    # tested so its permutation p-value is missing
+    # the null betas (permutations x features) of each tested variate are written
+    # next to the model results when requested
+    null_betas_path = (
+        pathlib.Path("../linear_models/lm_all_features_null_betas.npz").resolve()
+        if save_null_betas
+        else None
+    )
+    permutation_pvalues = permutation_test_mass_univariate_ols(
         X,
-        y,
-        feature,
+        df[feature_columns],
+        n_permutations=n_permutations,
+        seed=0,
+        null_betas_path=null_betas_path,
+    )
+    coefficient_names["permutation_p_value"] = (
+        permutation_pvalues.reindex(columns=model_results["params"].columns)
+        .to_numpy()
+        .ravel()
     )
-    # get the model coefficients and p-values
-    for variate in model.params.keys():
-        coefficient_names["beta"].append(model.params[variate])
-        coefficient_names["variate"].append(variate)
-    for pval in model.pvalues.keys():
-        coefficient_names["p_value"].append(model.pvalues[pval])
-        coefficient_names["r2"].append(model.rsquared)
-        coefficient_names["feature"].append(feature)
-    model_dict[feature] = model
 
 
-# In[8]:
+# In[ ]:
 
 
-# write the model to a file joblib
-joblib_path = pathlib.Path("../linear_models/lm_all_features.joblib").resolve()
-# write the model to a file
-joblib_path.parent.mkdir(parents=True, exist_ok=True)
-joblib.dump(model_dict, joblib_path)
+# write the model results to a compact file of per feature arrays
+# a single feature's model can be rehydrated with linear_model_utils.LinearModelResults
+model_results_path = pathlib.Path("../linear_models/lm_all_features.npz").resolve()
+save_model_results(model_results, model_results_path)
 
 
-# In[9]:
+# In[ ]:
 
 
 all_features_beta_df = pd.DataFrame.from_dict(coefficient_names)
-# remove any "Metadata_" string from the feature names
-all_features_beta_df["variate"] = all_features_beta_df["variate"].str.replace(
-    "Metadata_", ""
-)
-all_features_beta_df["variate"] = all_features_beta_df["variate"].str.replace(
-    "number_of_singlecells", "Cell count"
-)
+# give the variates readable names
+variate_labels = {
+    "const": "const",
+    time_column: "Time",
+    single_cells_count_column: "Cell count",
+    dose_column: "Dose",
+    interaction_column1: "Time x \nCell count",
+    interaction_column2: "Time x \nDose",
+}
+all_features_beta_df["variate"] = all_features_beta_df["variate"].map(variate_labels)
 all_features_beta_df.head()
 
 
 # Extract feature information and save the dataframe
 
-# In[10]:
-
-
-# split the df into two dfs, one with CP and with scDINO
-cp_df = all_features_beta_df[all_features_beta_df["feature"].str.contains("CP")]
-
-cp_df = cp_df.copy()
-cp_df[
-    [
-        "Compartment",
-        "Feature_type",
-        "Measurement",
-        "Channel",
-        "extra1",
-        "extra2",
-        "extra3",
-        "extra4",
-        "extra5",
-        "extra6",
-    ]
-] = cp_df["feature"].str.split("_", expand=True)
-cp_df["featurizer_id"] = "CP"
-
-
-# realign the channel and feature types - Cellprofiler outputs an unaligned df of feature names
-
-# make the areashape channel None
-cp_df.loc[cp_df["Feature_type"].str.contains("AreaShape"), "Channel"] = "None"
-
-cp_df.loc[cp_df["Channel"].str.contains("CL", na=False), "Channel"] = (
-    cp_df["Channel"].fillna("") + "_" + cp_df["extra1"].fillna("")
-)
-# merge the 488 with which emmission specrtra 1 or 2
-cp_df.loc[cp_df["Channel"].str.contains("488", na=False), "Channel"] = (
-    cp_df["Channel"].fillna("") + "_" + cp_df["extra2"].fillna("")
-)
-
-cp_df.loc[cp_df["extra1"].str.contains("CL", na=False), "extra1"] = (
-    cp_df["extra1"].fillna("") + "_" + cp_df["extra2"].fillna("")
-)
-cp_df.loc[cp_df["extra1"].str.contains("488", na=False), "extra1"] = (
-    cp_df["extra1"].fillna("") + "_" + cp_df["extra3"].fillna("")
-)
-
-# specify that it is ChomaLive (CL)
-cp_df.loc[cp_df["extra2"].str.contains("CL", na=False), "extra2"] = (
-    cp_df["extra2"].fillna("") + "_" + cp_df["extra3"].fillna("")
-)
-cp_df.loc[cp_df["extra2"].str.contains("488", na=False), "extra2"] = (
-    cp_df["extra2"].fillna("") + "_" + cp_df["extra4"].fillna("")
-)
-
-cp_df.loc[cp_df["extra3"].str.contains("CL", na=False), "extra3"] = (
-    cp_df["extra3"].fillna("") + "_" + cp_df["extra4"].fillna("")
-)
-cp_df.loc[cp_df["extra3"].str.contains("488", na=False), "extra3"] = (
-    cp_df["extra3"].fillna("") + "_" + cp_df["extra5"].fillna("")
-)
-
-cp_df.loc[cp_df["extra4"].str.contains("CL", na=False), "extra4"] = (
-    cp_df["extra4"].fillna("") + "_" + cp_df["extra5"].fillna("")
-)
-cp_df.loc[cp_df["extra4"].str.contains("488", na=False), "extra4"] = (
-    cp_df["extra4"].fillna("") + "_" + cp_df["extra6"].fillna("")
-)
-
-cp_df.rename(columns={"extra1": "Channel2"}, inplace=True)
-# remove the extra columns to retain the feature types and channels
-cp_df.drop(
-    columns=["Measurement", "extra2", "extra3", "extra4", "extra5", "extra6"],
-    inplace=True,
-)
-# make channel2 None if feature is not correlation
-cp_df.loc[~cp_df["Feature_type"].str.contains("Correlation"), "Channel2"] = "None"
+# In[ ]:
 
 
-# In[11]:
-
+# parse each unique feature name once and only keep the CP and scDINO features
+feature_info = parse_feature_names(all_features_beta_df["feature"].unique())
+feature_info = feature_info.loc[feature_info["featurizer_id"].notna()]
+for channel_column in ["Channel", "Channel2"]:
+    feature_info[channel_column] = feature_info[channel_column].cat.rename_categories(
+        CHANNEL_LABELS
+    )
 
-scdino_df = all_features_beta_df[all_features_beta_df["feature"].str.contains("scDINO")]
-scdino_df = scdino_df.copy()
-scdino_df["feature"] = scdino_df["feature"].str.replace("channel_", "")
-scdino_df["feature"] = scdino_df["feature"].str.replace("channel", "")
-scdino_df[["Channel", "remove", "feature", "feature_number", "featurizer_id"]] = (
-    scdino_df["feature"].str.split("_", expand=True)
+# join the feature information back onto the coefficients
+final_df = all_features_beta_df.merge(
+    feature_info, left_on="feature", right_index=True, how="inner"
 )
-scdino_df.drop(columns=["remove"], inplace=True)
-# set scDINO to be the feature type, Compartment and measurement
-# as scDINO does not have these features only a channel and feature number
-scdino_df[["Compartment", "Feature_type", "Measurement"]] = "scDINO"
-
-
-# In[12]:
-
-
-final_df = pd.concat([cp_df, scdino_df], axis=0)
-final_df["Channel"] = final_df["Channel"].str.replace("Adjacent", "None")
-
-final_df["Channel"] = final_df["Channel"].str.replace("CL_488_1", "488-1")
-final_df["Channel"] = final_df["Channel"].str.replace("CL_488_2", "488-2")
-final_df["Channel"] = final_df["Channel"].str.replace("CL_561", "561")
-final_df["Channel"] = final_df["Channel"].str.replace("488-1", "CL 488-1")
-final_df["Channel"] = final_df["Channel"].str.replace("488-2", "CL 488-2")
-final_df["Channel"] = final_df["Channel"].str.replace("561", "CL 561")
 final_df["Channel"].unique()
 
 
-# In[13]:
-
-
-final_df["variate"] = final_df["variate"].str.replace("dose", "Dose")
-final_df["variate"] = final_df["variate"].str.replace(
-    "interaction1", "Time x \nCell count"
-)
-final_df["variate"] = final_df["variate"].str.replace("interaction2", "Time x \nDose")
-
-
 # In[14]:
 
 
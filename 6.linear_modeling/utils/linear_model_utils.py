@@ -0,0 +1,441 @@
+import pathlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+import statsmodels.regression.linear_model
+from scipy import stats
+from statsmodels.tools.tools import pinv_extended
+
+# the per feature results that are stored as (features x variates) dataframes
+_COEFFICIENT_KEYS = ("params", "bse", "tvalues", "pvalues")
+# the per feature results that are stored as (features,) series
+_MODEL_KEYS = ("rsquared", "scale", "df_resid", "nobs")
+
+
+def _fit_ols_block(design: np.ndarray, Y: np.ndarray) -> dict:
+    """
+    Fit an OLS model to every column of Y with the same design matrix.
+    The design is factorized once and all of the features are solved as a single
+    matrix right-hand side, following the statsmodels OLS "pinv" method.
+
+    Parameters
+    ----------
+    design : np.ndarray
+        (n_samples, n_variates) design matrix including the constant
+    Y : np.ndarray
+        (n_samples, n_features) targets without any missing values
+
+    Returns
+    -------
+    dict
+        The params, bse, tvalues and pvalues (n_variates, n_features) arrays,
+        the rsquared, scale, df_resid and nobs (n_features,) arrays and the
+        shared (n_variates, n_variates) normalized_cov_params
+    """
+    pinv_design, singular_values = pinv_extended(design)
+    normalized_cov_params = pinv_design @ pinv_design.T
+    df_resid = design.shape[0] - np.linalg.matrix_rank(np.diag(singular_values))
+
+    params = pinv_design @ Y
+    resid = Y - design @ params
+    ssr = np.einsum("ij,ij->j", resid, resid)
+    scale = ssr / df_resid
+    bse = np.sqrt(np.diag(normalized_cov_params)[:, np.newaxis] * scale)
+    tvalues = params / bse
+    pvalues = stats.t.sf(np.abs(tvalues), df_resid) * 2
+    centered_Y = Y - Y.mean(axis=0)
+    centered_tss = np.einsum("ij,ij->j", centered_Y, centered_Y)
+
+    n_features = Y.shape[1]
+    return {
+        "params": params,
+        "bse": bse,
+        "tvalues": tvalues,
+        "pvalues": pvalues,
+        "rsquared": 1 - ssr / centered_tss,
+        "scale": scale,
+        "df_resid": np.full(n_features, df_resid),
+        "nobs": np.full(n_features, design.shape[0]),
+        "normalized_cov_params": normalized_cov_params,
+    }
+
+
+def _prepare_model_data(
+    X: pd.DataFrame, Y: pd.DataFrame
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Coerce X and Y to numeric, drop the rows with missing values in X and add the
+    constant to X, as done for every feature in the statsmodels OLS fits
+    """
+    # Ensure X and Y are numeric, Y is wide so only non-numeric columns are coerced
+    X = X.apply(pd.to_numeric, errors="coerce")
+    non_numeric_columns = Y.select_dtypes(exclude="number").columns
+    if len(non_numeric_columns) > 0:
+        Y = Y.copy()
+        Y[non_numeric_columns] = Y[non_numeric_columns].apply(
+            pd.to_numeric, errors="coerce"
+        )
+
+    # Drop rows with missing values and match the indices in the Y dataframe
+    X = X.dropna()
+    Y = Y.loc[X.index]
+
+    # Add a constant for the intercept
+    X = sm.add_constant(X)
+    return X, Y
+
+
+def _group_features_by_missing_rows(
+    Y_values: np.ndarray, n_variates: int
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Group the features by their missing rows so that each group shares a design.
+    The complete features are all in the first group and groups without enough
+    rows left to estimate the model are skipped.
+
+    Parameters
+    ----------
+    Y_values : np.ndarray
+        (n_samples, n_features) targets
+    n_variates : int
+        The number of variates of the design, including the constant
+
+    Returns
+    -------
+    list[tuple[np.ndarray, np.ndarray]]
+        The feature indices of each group and the boolean mask of its present rows
+    """
+    missing = np.isnan(Y_values)
+    has_missing = missing.any(axis=0)
+    feature_groups = [
+        (np.flatnonzero(~has_missing), np.ones(len(Y_values), dtype=bool))
+    ]
+    if has_missing.any():
+        incomplete_features = np.flatnonzero(has_missing)
+        # pack the missing rows into bytes so each pattern is compared as one row
+        packed_missing = np.packbits(missing[:, incomplete_features], axis=0).T
+        _, first_index, pattern_index = np.unique(
+            packed_missing, axis=0, return_index=True, return_inverse=True
+        )
+        pattern_index = pattern_index.ravel()
+        for i, feature in enumerate(incomplete_features[first_index]):
+            feature_groups.append(
+                (incomplete_features[pattern_index == i], ~missing[:, feature])
+            )
+    return [
+        (feature_index, present_rows)
+        for feature_index, present_rows in feature_groups
+        if len(feature_index) > 0 and present_rows.sum() > n_variates
+    ]
+
+
+def fit_mass_univariate_ols(X: pd.DataFrame, Y: pd.DataFrame) -> dict:
+    """
+    Fit the same linear model to every feature at once.
+    This returns the same estimates as fitting a statsmodels OLS model with a
+    constant to each column of Y, without looping over the features.
+
+    Rows with a missing value in X are dropped for every feature.
+    Features with missing values are fit on the rows where they are present,
+    with the features that share the same missing rows solved together.
+
+    Parameters
+    ----------
+    X : pd.DataFrame
+        The variates to fit on, the constant is added here
+    Y : pd.DataFrame
+        The features to fit, one model per column
+
+    Returns
+    -------
+    dict
+        The params, bse, tvalues and pvalues dataframes (features x variates),
+        the rsquared, scale, df_resid and nobs series (features) and the
+        normalized_cov_params array (features x variates x variates)
+    """
+    X, Y = _prepare_model_data(X, Y)
+
+    design = X.to_numpy(dtype=np.float64)
+    Y_values = Y.to_numpy(dtype=np.float64)
+    n_variates = design.shape[1]
+    n_features = Y_values.shape[1]
+
+    results = {
+        "params": np.full((n_variates, n_features), np.nan),
+        "bse": np.full((n_variates, n_features), np.nan),
+        "tvalues": np.full((n_variates, n_features), np.nan),
+        "pvalues": np.full((n_variates, n_features), np.nan),
+        "rsquared": np.full(n_features, np.nan),
+        "scale": np.full(n_features, np.nan),
+        "df_resid": np.zeros(n_features, dtype=np.int64),
+        "nobs": np.zeros(n_features, dtype=np.int64),
+        "normalized_cov_params": np.full((n_features, n_variates, n_variates), np.nan),
+    }
+
+    for feature_index, present_rows in _group_features_by_missing_rows(
+        Y_values, n_variates
+    ):
+        block = _fit_ols_block(
+            design[present_rows],
+            Y_values[np.ix_(present_rows, feature_index)],
+        )
+        for key in _COEFFICIENT_KEYS:
+            results[key][:, feature_index] = block[key]
+        for key in _MODEL_KEYS:
+            results[key][feature_index] = block[key]
+        results["normalized_cov_params"][feature_index] = block["normalized_cov_params"]
+
+    for key in _COEFFICIENT_KEYS:
+        results[key] = pd.DataFrame(results[key].T, index=Y.columns, columns=X.columns)
+    for key in _MODEL_KEYS:
+        results[key] = pd.Series(results[key], index=Y.columns, name=key)
+    return results
+
+
+def permutation_test_mass_univariate_ols(
+    X: pd.DataFrame,
+    Y: pd.DataFrame,
+    n_permutations: int = 1000,
+    seed: int = 0,
+    batch_size: int = 100,
+    null_betas_path: pathlib.Path = None,
+) -> pd.DataFrame:
+    """
+    Permutation test of the betas of fit_mass_univariate_ols.
+    The rows of the response block are shuffled relative to the design and
+    every feature is refit for each permutation. The design is factorized once:
+    permuting the response rows is the same as permuting the columns of the
+    pseudo-inverse of the design, so a batch of permutations is solved for all
+    features with a single matrix product. Only the number of permuted betas at
+    least as extreme as the observed beta is kept per feature block, so memory
+    does not grow with the number of permutations.
+
+    The null distribution of the betas is only kept when null_betas_path is
+    given. The (n_permutations, n_features) float32 null betas of each tested
+    variate are then streamed into memory-mapped files as the batches are solved
+    and written to a single .npz file, one entry per variate, so memory stays
+    bounded as well.
+
+    The constant is not tested, permuting the responses does not change their
+    mean so the null of the intercept is degenerate.
+
+    Parameters
+    ----------
+    X : pd.DataFrame
+        The variates to fit on, the constant is added here
+    Y : pd.DataFrame
+        The features to fit, one model per column
+    n_permutations : int, optional
+        The number of permutations, by default 1000
+    seed : int, optional
+        Random seed for reproducibility, by default 0
+    batch_size : int, optional
+        The number of permutations solved together, by default 100
+    null_betas_path : pathlib.Path, optional
+        The .npz file to write the null betas of each tested variate to, with the
+        feature names in the "feature" entry, by default None which only keeps
+        the exceedance counts
+
+    Returns
+    -------
+    pd.DataFrame
+        The two-sided empirical p-values (features x variates without the
+        constant)
+    """
+    X, Y = _prepare_model_data(X, Y)
+    design = X.to_numpy(dtype=np.float64)
+    Y_values = Y.to_numpy(dtype=np.float64)
+    n_variates = design.shape[1]
+    tested_variates = np.flatnonzero(X.columns != "const")
+    rng = np.random.default_rng(seed)
+
+    null_betas = None
+    if null_betas_path is not None:
+        null_betas_path = pathlib.Path(null_betas_path)
+        null_betas_path.parent.mkdir(parents=True, exist_ok=True)
+        # the memory-mapped null betas are written next to the .npz file
+        null_betas_dir = tempfile.TemporaryDirectory(dir=null_betas_path.parent)
+        null_betas = [
+            np.lib.format.open_memmap(
+                pathlib.Path(null_betas_dir.name) / f"{i}.npy",
+                mode="w+",
+                dtype=np.float32,
+                shape=(n_permutations, Y_values.shape[1]),
+            )
+            for i in range(len(tested_variates))
+        ]
+        for variate_null_betas in null_betas:
+            # features that are not fit have no null betas
+            variate_null_betas[:] = np.nan
+
+    permutation_pvalues = np.full((Y_values.shape[1], len(tested_variates)), np.nan)
+    for feature_index, present_rows in _group_features_by_missing_rows(
+        Y_values, n_variates
+    ):
+        pinv_design, _ = pinv_extended(design[present_rows])
+        pinv_design = pinv_design[tested_variates]
+        group_Y = Y_values[np.ix_(present_rows, feature_index)]
+        abs_observed_params = np.abs(pinv_design @ group_Y)
+        n_rows = group_Y.shape[0]
+
+        exceedances = np.zeros(abs_observed_params.shape, dtype=np.int64)
+        for start in range(0, n_permutations, batch_size):
+            stop = min(start + batch_size, n_permutations)
+            permutations = rng.permuted(
+                np.tile(np.arange(n_rows), (stop - start, 1)), axis=1
+            )
+            # (n_permutations in batch * n_variates, n_rows) stacked pseudo-inverses
+            permuted_pinv = pinv_design[:, permutations].transpose(1, 0, 2)
+            batch_params = (permuted_pinv.reshape(-1, n_rows) @ group_Y).reshape(
+                stop - start, len(tested_variates), len(feature_index)
+            )
+            exceedances += (np.abs(batch_params) >= abs_observed_params).sum(axis=0)
+            if null_betas is not None:
+                for i, variate_null_betas in enumerate(null_betas):
+                    variate_null_betas[start:stop, feature_index] = batch_params[:, i]
+        permutation_pvalues[feature_index] = (
+            (exceedances + 1) / (n_permutations + 1)
+        ).T
+
+    if null_betas is not None:
+        # np.savez writes the memory-mapped arrays in chunks
+        np.savez(
+            null_betas_path,
+            feature=Y.columns.to_numpy(dtype=str),
+            **{
+                variate: variate_null_betas
+                for variate, variate_null_betas in zip(
+                    X.columns[tested_variates], null_betas
+                )
+            },
+        )
+        null_betas_dir.cleanup()
+
+    return pd.DataFrame(
+        permutation_pvalues, index=Y.columns, columns=X.columns[tested_variates]
+    )
+
+
+def save_model_results(model_results: dict, results_file_path: pathlib.Path) -> None:
+    """
+    Write the results of fit_mass_univariate_ols to a single .npz file of
+    columnar arrays, one entry per feature, without any of the fitted data
+
+    Parameters
+    ----------
+    model_results : dict
+        The results returned by fit_mass_univariate_ols
+    results_file_path : pathlib.Path
+        The path to the .npz file to write
+    """
+    params = model_results["params"]
+    arrays = {
+        "feature": params.index.to_numpy(dtype=str),
+        "variate": params.columns.to_numpy(dtype=str),
+        "normalized_cov_params": model_results["normalized_cov_params"],
+    }
+    for key in _COEFFICIENT_KEYS + _MODEL_KEYS:
+        arrays[key] = model_results[key].to_numpy()
+    pathlib.Path(results_file_path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez(results_file_path, **arrays)
+
+
+class LinearModelResults:
+    """
+    Lazy accessor of the linear model results written by save_model_results.
+    Arrays are only read from the .npz file the first time they are used and a
+    single feature's fitted model can be rehydrated without refitting.
+
+    Parameters
+    ----------
+    results_file_path : pathlib.Path
+        The path to the .npz file written by save_model_results
+    """
+
+    def __init__(self, results_file_path: pathlib.Path):
+        self.results_file_path = pathlib.Path(results_file_path)
+        self._npz_file = np.load(self.results_file_path, allow_pickle=False)
+        self._arrays = {}
+        self.features = pd.Index(self._get_array("feature"), name="feature")
+        self.variates = pd.Index(self._get_array("variate"), name="variate")
+
+    def _get_array(self, key: str) -> np.ndarray:
+        if key not in self._arrays:
+            self._arrays[key] = self._npz_file[key]
+        return self._arrays[key]
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+    def __contains__(self, feature: str) -> bool:
+        return feature in self.features
+
+    def __getitem__(self, key: str) -> pd.DataFrame | pd.Series:
+        """
+        Get a result for every feature, e.g. results["params"] or results["rsquared"]
+        """
+        if key in _COEFFICIENT_KEYS:
+            return pd.DataFrame(
+                self._get_array(key), index=self.features, columns=self.variates
+            )
+        if key in _MODEL_KEYS:
+            return pd.Series(self._get_array(key), index=self.features, name=key)
+        raise KeyError(key)
+
+    def get_coefficients(self, feature: str) -> pd.DataFrame:
+        """
+        Get the coefficient table of a single feature
+
+        Parameters
+        ----------
+        feature : str
+            The feature name
+
+        Returns
+        -------
+        pd.DataFrame
+            The params, bse, tvalues and pvalues of each variate of the feature
+        """
+        feature_index = self.features.get_loc(feature)
+        return pd.DataFrame(
+            {key: self._get_array(key)[feature_index] for key in _COEFFICIENT_KEYS},
+            index=self.variates,
+        )
+
+    def get_model(
+        self, feature: str, X: pd.DataFrame, y: pd.Series
+    ) -> statsmodels.regression.linear_model.RegressionResultsWrapper:
+        """
+        Rehydrate the fitted statsmodels model of a single feature, e.g. for
+        plotting, from the stored estimates instead of refitting it
+
+        Parameters
+        ----------
+        feature : str
+            The feature name
+        X : pd.DataFrame
+            The variates the model was fit on, without the constant
+        y : pd.Series
+            The feature values the model was fit on
+
+        Returns
+        -------
+        statsmodels.regression.linear_model.RegressionResultsWrapper
+            The fitted model
+        """
+        feature_index = self.features.get_loc(feature)
+        # match the rows and constant used by fit_mass_univariate_ols
+        X = X.apply(pd.to_numeric, errors="coerce").dropna()
+        y = pd.to_numeric(y, errors="coerce").loc[X.index]
+        model = sm.OLS(y, sm.add_constant(X), missing="drop")
+        results = statsmodels.regression.linear_model.OLSResults(
+            model,
+            self._get_array("params")[feature_index],
+            normalized_cov_params=self._get_array("normalized_cov_params")[
+                feature_index
+            ],
+            scale=self._get_array("scale")[feature_index],
+        )
+        return statsmodels.regression.linear_model.RegressionResultsWrapper(results)
@@ -5,26 +5,19 @@
 # This is necessary because  the endpoint data was not included in the tracking module.
 # Further this notebook provides information about how long the cell track is.
 
-# In[1]:
+# In[ ]:
 
 
+import os
 import pathlib
+import sys
 import time
 
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import euclidean
-
-try:
-    cfg = get_ipython().config
-    in_notebook = True
-except NameError:
-    in_notebook = False
-if in_notebook:
-    from tqdm.notebook import tqdm
-else:
-    from tqdm import tqdm
 
+sys.path.append("../utils")
+from spatial_join_utils import match_endpoints_to_tracks
 
 # In[2]:
 
@@ -78,61 +71,25 @@ last_time_point_df = sc_profile_df.loc[
 ]
 
 
-# In[ ]:
-
-
-# chunk the dataframe by well_fov so that there are fewer indexed records to search at once during fuzzy matching
-dict_of_sc_well_fovs = {}
-for well_fov in last_time_point_df["Metadata_Well_FOV"].unique():
-    dict_of_sc_well_fovs[well_fov] = last_time_point_df[
-        last_time_point_df["Metadata_Well_FOV"] == well_fov
-    ].copy()
-    # get only the last timepoint of the track
-
-    dict_of_sc_well_fovs[well_fov].reset_index(drop=True, inplace=True)
-dict_of_sc_well_fovs_endpoint = {}
-for well_fov in endpoint_sc_profile_df["Metadata_Well_FOV"].unique():
-    dict_of_sc_well_fovs_endpoint[well_fov] = endpoint_sc_profile_df[
-        endpoint_sc_profile_df["Metadata_Well_FOV"] == well_fov
-    ].copy()
-    dict_of_sc_well_fovs_endpoint[well_fov].reset_index(drop=True, inplace=True)
-
-
 # In[7]:
 
 
 start_time = time.time()
 
 
-# In[8]:
-
-
-for well_fov in tqdm(list(dict_of_sc_well_fovs.keys()), desc="Processing Well-FOVs"):
-    for i, row in tqdm(
-        dict_of_sc_well_fovs[well_fov].iterrows(),
-        total=len(dict_of_sc_well_fovs[well_fov]),
-        desc="Outer Loop",
-        leave=False,
-    ):
-        for j, row2 in dict_of_sc_well_fovs_endpoint[well_fov].iterrows():
-            # check that the well_fov is the same
-            if row["Metadata_Well_FOV"] == row2["Metadata_Well_FOV"]:
-                distance = abs(
-                    euclidean(
-                        [
-                            row["Metadata_Nuclei_Location_Center_X"],
-                            row["Metadata_Nuclei_Location_Center_Y"],
-                        ],
-                        [
-                            row2["Metadata_Nuclei_Location_Center_X"],
-                            row2["Metadata_Nuclei_Location_Center_Y"],
-                        ],
-                    )
-                )
-                if distance < 10:
-                    dict_of_sc_well_fovs_endpoint[well_fov].at[
-                        j, "Metadata_sc_unique_track_id"
-                    ] = row["Metadata_sc_unique_track_id"]
+# In[ ]:
+
+
+# fuzzy match the endpoint single-cells to the nearest tracked single-cell in the same well_fov
+# a KD-tree is built per well_fov so each endpoint nucleus is queried at once instead of compared pairwise
+# the well_fovs are matched in parallel, only the coordinates are shared with the worker processes
+n_workers = os.cpu_count()
+sc_well_fovs_endpoint_df = match_endpoints_to_tracks(
+    sc_df=last_time_point_df,
+    endpoint_df=endpoint_sc_profile_df,
+    distance_threshold=10,
+    n_workers=n_workers,
+)
 
 
 # In[9]:
@@ -144,12 +101,9 @@ print(f"Took {round((time.time() - start_time) / 60, 2)} minutes")
 print(f"Took {round((time.time() - start_time) / 3600, 2)} hours")
 
 
-# In[10]:
+# In[ ]:
 
 
-sc_well_fovs_endpoint_df = pd.concat(
-    dict_of_sc_well_fovs_endpoint.values(), ignore_index=True
-)
 # drop the rows where Metadata_sc_unique_track_id is NaN
 sc_well_fovs_endpoint_df = sc_well_fovs_endpoint_df.dropna(
     subset=["Metadata_sc_unique_track_id"]
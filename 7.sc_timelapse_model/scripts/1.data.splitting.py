@@ -11,6 +11,7 @@
 
 import itertools
 import pathlib
+import sys
 
 import numpy as np
 import pandas as pd
@@ -27,6 +28,8 @@ if in_notebook:
 else:
     from tqdm import tqdm
 
+sys.path.append("../../utils")
+from data_access_utils import load_profiles
 
 # In[ ]:
 
@@ -43,8 +46,13 @@ train_test_wells_file_path = pathlib.Path(
     "../../5.bulk_timelapse_model/data_splits/train_test_wells.parquet"
 ).resolve(strict=True)
 
-sc_profile = pd.read_parquet(sc_file_path)
-sc_endpoint_profile = pd.read_parquet(sc_endpoint_file_path)
+# the data splits only depend on the metadata so the features are never read
+sc_profile = load_profiles(sc_file_path, feature_set=None)
+sc_endpoint_profile = load_profiles(
+    sc_endpoint_file_path,
+    feature_set=None,
+    metadata_columns=["Metadata_sc_unique_track_id"],
+)
 train_test_wells = pd.read_parquet(train_test_wells_file_path)
 print(f"sc_profile shape: {sc_profile.shape}")
 print(f"sc_endpoint_profile shape: {sc_endpoint_profile.shape}")
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# This notebook benchmarks the KD-tree fuzzy match in `utils/spatial_join_utils.py` against the original nested `iterrows()` loop that was used in `0.data_cleaning.ipynb`.
+# Synthetic Well-FOVs of 1k to 50k nuclei are generated where each endpoint nucleus is a jittered copy of a tracked nucleus.
+# The original loop is quadratic, so for the larger Well-FOVs its runtime is extrapolated from a subset of the outer loop.
+
+# In[ ]:
+
+
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import euclidean
+
+sys.path.append("../utils")
+from spatial_join_utils import match_endpoints_to_tracks
+
+# In[ ]:
+
+
+def generate_synthetic_fov(
+    n_nuclei: int,
+    image_size: int = 1900,
+    jitter: float = 3,
+    seed: int = 0,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Generate a synthetic Well-FOV of tracked nuclei and jittered endpoint nuclei
+
+    Parameters
+    ----------
+    n_nuclei : int
+        The number of tracked nuclei and endpoint nuclei in the Well-FOV
+    image_size : int, optional
+        The width and height of the image in pixels, by default 1900
+    jitter : float, optional
+        The maximum displacement in pixels of each endpoint nucleus, by default 3
+    seed : int, optional
+        Random seed for reproducibility, by default 0
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.DataFrame]
+        The tracked single-cell and the endpoint single-cell dataframes
+    """
+    rng = np.random.default_rng(seed)
+    coordinates = rng.uniform(0, image_size, size=(n_nuclei, 2))
+    sc_df = pd.DataFrame(
+        {
+            "Metadata_Well_FOV": "C-02_0001",
+            "Metadata_Nuclei_Location_Center_X": coordinates[:, 0],
+            "Metadata_Nuclei_Location_Center_Y": coordinates[:, 1],
+            "Metadata_sc_unique_track_id": [
+                f"C-02_0001_{track_id}" for track_id in range(n_nuclei)
+            ],
+        }
+    )
+    endpoint_coordinates = coordinates + rng.uniform(
+        -jitter, jitter, size=coordinates.shape
+    )
+    endpoint_df = pd.DataFrame(
+        {
+            "Metadata_Well_FOV": "C-02_0001",
+            "Metadata_Nuclei_Location_Center_X": endpoint_coordinates[:, 0],
+            "Metadata_Nuclei_Location_Center_Y": endpoint_coordinates[:, 1],
+        }
+    )
+    return sc_df, endpoint_df
+
+
+def legacy_fuzzy_match(
+    sc_df: pd.DataFrame,
+    endpoint_df: pd.DataFrame,
+    n_outer_rows: int = None,
+) -> pd.DataFrame:
+    """
+    The original nested iterrows fuzzy match from 0.data_cleaning.ipynb
+
+    Parameters
+    ----------
+    sc_df : pd.DataFrame
+        The tracked single-cells of a single Well-FOV
+    endpoint_df : pd.DataFrame
+        The endpoint single-cells of a single Well-FOV
+    n_outer_rows : int, optional
+        Only run the first n rows of the outer loop, by default None (all rows)
+
+    Returns
+    -------
+    pd.DataFrame
+        The endpoint single-cells with the matched track id
+    """
+    endpoint_df = endpoint_df.copy()
+    for i, row in sc_df.head(n_outer_rows).iterrows():
+        for j, row2 in endpoint_df.iterrows():
+            if row["Metadata_Well_FOV"] == row2["Metadata_Well_FOV"]:
+                distance = abs(
+                    euclidean(
+                        [
+                            row["Metadata_Nuclei_Location_Center_X"],
+                            row["Metadata_Nuclei_Location_Center_Y"],
+                        ],
+                        [
+                            row2["Metadata_Nuclei_Location_Center_X"],
+                            row2["Metadata_Nuclei_Location_Center_Y"],
+                        ],
+                    )
+                )
+                if distance < 10:
+                    endpoint_df.at[j, "Metadata_sc_unique_track_id"] = row[
+                        "Metadata_sc_unique_track_id"
+                    ]
+    return endpoint_df
+
+
+# In[ ]:
+
+
+benchmark_results_path = pathlib.Path(
+    "../results/spatial_join_benchmark.parquet"
+).resolve()
+benchmark_results_path.parent.mkdir(parents=True, exist_ok=True)
+
+fov_sizes = [1000, 5000, 10000, 50000]
+# the outer loop of the legacy match is timed on this many rows and scaled up
+n_legacy_outer_rows = 25
+
+
+# In[ ]:
+
+
+benchmark_results = {
+    "n_nuclei": [],
+    "kd_tree_seconds": [],
+    "legacy_seconds": [],
+    "legacy_extrapolated": [],
+    "matched_fraction": [],
+}
+for n_nuclei in fov_sizes:
+    sc_df, endpoint_df = generate_synthetic_fov(n_nuclei)
+
+    start_time = time.perf_counter()
+    matched_df = match_endpoints_to_tracks(sc_df, endpoint_df, distance_threshold=10)
+    kd_tree_seconds = time.perf_counter() - start_time
+
+    n_outer_rows = min(n_nuclei, n_legacy_outer_rows)
+    start_time = time.perf_counter()
+    _ = legacy_fuzzy_match(sc_df, endpoint_df, n_outer_rows=n_outer_rows)
+    legacy_seconds = (time.perf_counter() - start_time) * n_nuclei / n_outer_rows
+
+    benchmark_results["n_nuclei"].append(n_nuclei)
+    benchmark_results["kd_tree_seconds"].append(kd_tree_seconds)
+    benchmark_results["legacy_seconds"].append(legacy_seconds)
+    benchmark_results["legacy_extrapolated"].append(n_outer_rows < n_nuclei)
+    benchmark_results["matched_fraction"].append(
+        matched_df["Metadata_sc_unique_track_id"].notna().mean()
+    )
+
+
+# In[ ]:
+
+
+benchmark_df = pd.DataFrame.from_dict(benchmark_results)
+benchmark_df["speedup"] = (
+    benchmark_df["legacy_seconds"] / benchmark_df["kd_tree_seconds"]
+)
+benchmark_df.to_parquet(benchmark_results_path, index=False)
+benchmark_df
+
+
+# Check that the KD-tree match agrees with the legacy loop on a Well-FOV small enough to run the full loop.
+# The legacy loop keeps the last tracked nucleus within the threshold while the KD-tree keeps the nearest one, so only unambiguous endpoints are compared.
+
+# In[ ]:
+
+
+sc_df, endpoint_df = generate_synthetic_fov(500, image_size=500, seed=1)
+legacy_df = legacy_fuzzy_match(sc_df, endpoint_df)
+kd_tree_df = match_endpoints_to_tracks(sc_df, endpoint_df, distance_threshold=10)
+
+# count how many tracked nuclei are within the threshold of each endpoint nucleus
+distances = np.linalg.norm(
+    endpoint_df[
+        ["Metadata_Nuclei_Location_Center_X", "Metadata_Nuclei_Location_Center_Y"]
+    ].to_numpy()[:, None, :]
+    - sc_df[
+        ["Metadata_Nuclei_Location_Center_X", "Metadata_Nuclei_Location_Center_Y"]
+    ].to_numpy()[None, :, :],
+    axis=2,
+)
+unambiguous = (distances < 10).sum(axis=1) <= 1
+assert legacy_df.loc[unambiguous, "Metadata_sc_unique_track_id"].equals(
+    kd_tree_df.loc[unambiguous, "Metadata_sc_unique_track_id"]
+)
+print(f"{unambiguous.sum()} unambiguous endpoints agree")
+print(f"{(~unambiguous).sum()} endpoints had more than one tracked nucleus in range")
@@ -0,0 +1,331 @@
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# coordinate arrays attached from shared memory in each worker process
+_shared_coordinates = {}
+
+
+def match_fov_coordinates(
+    track_coordinates: np.ndarray,
+    endpoint_coordinates: np.ndarray,
+    distance_threshold: float = 10,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Match the endpoint nuclei of a single Well-FOV to the nearest tracked nuclei
+
+    Parameters
+    ----------
+    track_coordinates : np.ndarray
+        (n_tracked_nuclei, 2) array of X/Y coordinates from the tracked profiles
+    endpoint_coordinates : np.ndarray
+        (n_endpoint_nuclei, 2) array of X/Y coordinates from the endpoint profiles
+    distance_threshold : float, optional
+        Maximum euclidean distance (exclusive) in pixels for a match, by default 10
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The positional indices of the matched endpoint nuclei and the positional
+        indices of the tracked nuclei they were matched to.
+        When several tracked nuclei are within the threshold of an endpoint
+        nucleus the nearest one wins.
+    """
+    if len(track_coordinates) == 0 or len(endpoint_coordinates) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    tree = cKDTree(track_coordinates)
+    distances, track_index = tree.query(
+        endpoint_coordinates, k=1, distance_upper_bound=distance_threshold
+    )
+    # unmatched points are returned with an infinite distance
+    matched = distances < distance_threshold
+    return np.flatnonzero(matched), track_index[matched]
+
+
+def _attach_shared_coordinates(shared_arrays: dict) -> None:
+    """
+    Pool initializer that attaches each worker to the shared coordinate arrays
+
+    Parameters
+    ----------
+    shared_arrays : dict
+        Mapping of array name to (shared memory name, shape, dtype)
+    """
+    for array_name, (shm_name, shape, dtype) in shared_arrays.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        # keep a reference to the shared memory so the buffer is not released
+        _shared_coordinates[array_name] = (
+            shm,
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+        )
+
+
+def _match_well_fovs(
+    track_coordinates: np.ndarray,
+    endpoint_coordinates: np.ndarray,
+    well_fov_offsets: list[tuple[int, int, int, int]],
+    distance_threshold: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Match each Well-FOV of coordinate arrays that are sorted by Well-FOV
+
+    Parameters
+    ----------
+    track_coordinates : np.ndarray
+        (n_tracked_nuclei, 2) coordinates sorted so that each Well-FOV is contiguous
+    endpoint_coordinates : np.ndarray
+        (n_endpoint_nuclei, 2) coordinates sorted so that each Well-FOV is contiguous
+    well_fov_offsets : list[tuple[int, int, int, int]]
+        The (start, stop) offsets of the tracked nuclei followed by the (start, stop)
+        offsets of the endpoint nuclei of each Well-FOV
+    distance_threshold : float
+        Maximum euclidean distance (exclusive) in pixels for a match
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The indices of the matched endpoint nuclei and of their tracked nuclei
+    """
+    endpoint_matches = [np.empty(0, dtype=np.intp)]
+    track_matches = [np.empty(0, dtype=np.intp)]
+    for sc_start, sc_stop, endpoint_start, endpoint_stop in well_fov_offsets:
+        endpoint_index, track_index = match_fov_coordinates(
+            track_coordinates[sc_start:sc_stop],
+            endpoint_coordinates[endpoint_start:endpoint_stop],
+            distance_threshold=distance_threshold,
+        )
+        endpoint_matches.append(endpoint_index + endpoint_start)
+        track_matches.append(track_index + sc_start)
+    return np.concatenate(endpoint_matches), np.concatenate(track_matches)
+
+
+def _match_well_fov_chunk(
+    well_fov_offsets: list[tuple[int, int, int, int]],
+    distance_threshold: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Match a chunk of Well-FOVs using the coordinates in shared memory
+
+    Parameters
+    ----------
+    well_fov_offsets : list[tuple[int, int, int, int]]
+        The tracked and endpoint offsets of each Well-FOV in the shared arrays
+    distance_threshold : float
+        Maximum euclidean distance (exclusive) in pixels for a match
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The indices of the matched endpoint nuclei and of their tracked nuclei
+        in the shared arrays
+    """
+    return _match_well_fovs(
+        _shared_coordinates["track"][1],
+        _shared_coordinates["endpoint"][1],
+        well_fov_offsets,
+        distance_threshold,
+    )
+
+
+def _chunk_well_fovs_by_size(
+    well_fov_offsets: list[tuple[int, int, int, int]],
+    n_chunks: int,
+) -> list[list[tuple[int, int, int, int]]]:
+    """
+    Greedily pack the Well-FOVs into chunks of similar total size.
+    The largest Well-FOVs are placed first, each into the currently smallest chunk.
+
+    Parameters
+    ----------
+    well_fov_offsets : list[tuple[int, int, int, int]]
+        The tracked and endpoint offsets of each Well-FOV
+    n_chunks : int
+        The number of chunks to pack the Well-FOVs into
+
+    Returns
+    -------
+    list[list[tuple[int, int, int, int]]]
+        The non-empty chunks of Well-FOV offsets
+    """
+    chunks = [[] for _ in range(n_chunks)]
+    chunk_sizes = [(0, chunk_index) for chunk_index in range(n_chunks)]
+    for offsets in sorted(
+        well_fov_offsets,
+        key=lambda offsets: (offsets[1] - offsets[0]) + (offsets[3] - offsets[2]),
+        reverse=True,
+    ):
+        chunk_size, chunk_index = heapq.heappop(chunk_sizes)
+        chunks[chunk_index].append(offsets)
+        chunk_size += (offsets[1] - offsets[0]) + (offsets[3] - offsets[2])
+        heapq.heappush(chunk_sizes, (chunk_size, chunk_index))
+    return [chunk for chunk in chunks if chunk]
+
+
+def _match_well_fovs_in_parallel(
+    track_coordinates: np.ndarray,
+    endpoint_coordinates: np.ndarray,
+    well_fov_offsets: list[tuple[int, int, int, int]],
+    distance_threshold: float,
+    n_workers: int,
+    n_chunks: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Match the Well-FOVs across a process pool.
+    Only the coordinate arrays are placed in shared memory, the workers receive
+    the Well-FOV offsets and return the matched indices.
+
+    Parameters
+    ----------
+    track_coordinates : np.ndarray
+        (n_tracked_nuclei, 2) coordinates sorted so that each Well-FOV is contiguous
+    endpoint_coordinates : np.ndarray
+        (n_endpoint_nuclei, 2) coordinates sorted so that each Well-FOV is contiguous
+    well_fov_offsets : list[tuple[int, int, int, int]]
+        The tracked and endpoint offsets of each Well-FOV
+    distance_threshold : float
+        Maximum euclidean distance (exclusive) in pixels for a match
+    n_workers : int
+        The number of worker processes
+    n_chunks : int
+        The number of chunks the Well-FOVs are packed into
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The indices of the matched endpoint nuclei and of their tracked nuclei
+    """
+    shared_memories = []
+    shared_arrays = {}
+    try:
+        for array_name, array in (
+            ("track", track_coordinates),
+            ("endpoint", endpoint_coordinates),
+        ):
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared_memories.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+            shared_arrays[array_name] = (shm.name, array.shape, array.dtype)
+
+        # the workers are forked, as the nbconverted data cleaning script has no
+        # __main__ guard that a spawned worker could safely re-import
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_attach_shared_coordinates,
+            initargs=(shared_arrays,),
+        ) as executor:
+            futures = [
+                executor.submit(_match_well_fov_chunk, chunk, distance_threshold)
+                for chunk in _chunk_well_fovs_by_size(well_fov_offsets, n_chunks)
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        for shm in shared_memories:
+            shm.close()
+            shm.unlink()
+
+    endpoint_matches = [np.empty(0, dtype=np.intp)]
+    track_matches = [np.empty(0, dtype=np.intp)]
+    for endpoint_index, track_index in results:
+        endpoint_matches.append(endpoint_index)
+        track_matches.append(track_index)
+    return np.concatenate(endpoint_matches), np.concatenate(track_matches)
+
+
+def match_endpoints_to_tracks(
+    sc_df: pd.DataFrame,
+    endpoint_df: pd.DataFrame,
+    distance_threshold: float = 10,
+    well_fov_column: str = "Metadata_Well_FOV",
+    x_column: str = "Metadata_Nuclei_Location_Center_X",
+    y_column: str = "Metadata_Nuclei_Location_Center_Y",
+    track_id_column: str = "Metadata_sc_unique_track_id",
+    n_workers: int = 1,
+    n_chunks: int = None,
+) -> pd.DataFrame:
+    """
+    Fuzzy match the endpoint single-cells to the tracked single-cells by location.
+    A KD-tree is built per Well-FOV over the tracked nuclei and all endpoint nuclei
+    of that Well-FOV are queried at once.
+    With more than one worker the Well-FOVs are matched across a process pool that
+    only shares the coordinate arrays, not the feature columns.
+
+    Parameters
+    ----------
+    sc_df : pd.DataFrame
+        The tracked single-cell profiles with the Well-FOV, location, and track id columns
+    endpoint_df : pd.DataFrame
+        The endpoint single-cell profiles with the Well-FOV and location columns
+    distance_threshold : float, optional
+        Maximum euclidean distance (exclusive) in pixels for a match, by default 10
+    well_fov_column : str, optional
+        The column name for the Well-FOV, by default "Metadata_Well_FOV"
+    x_column : str, optional
+        The column name for the X coordinate, by default "Metadata_Nuclei_Location_Center_X"
+    y_column : str, optional
+        The column name for the Y coordinate, by default "Metadata_Nuclei_Location_Center_Y"
+    track_id_column : str, optional
+        The column name for the track id, by default "Metadata_sc_unique_track_id"
+    n_workers : int, optional
+        The number of processes to match the Well-FOVs with, by default 1 (serial)
+    n_chunks : int, optional
+        The number of similarly sized chunks of Well-FOVs that are sent to the pool,
+        by default None which uses four chunks per worker
+
+    Returns
+    -------
+    pd.DataFrame
+        A copy of the endpoint profiles with the track id column added.
+        Endpoint single-cells without a match have a NaN track id.
+    """
+    # sort both profiles by Well-FOV so that each Well-FOV is a contiguous slice
+    well_fovs = pd.Index(endpoint_df[well_fov_column].unique())
+    sc_codes = well_fovs.get_indexer(sc_df[well_fov_column])
+    endpoint_codes = well_fovs.get_indexer(endpoint_df[well_fov_column])
+    sc_order = np.argsort(sc_codes, kind="stable")
+    endpoint_order = np.argsort(endpoint_codes, kind="stable")
+    # tracked single-cells from Well-FOVs without endpoints have a code of -1
+    code_range = np.arange(len(well_fovs) + 1)
+    sc_bounds = np.searchsorted(sc_codes[sc_order], code_range)
+    endpoint_bounds = np.searchsorted(endpoint_codes[endpoint_order], code_range)
+    well_fov_offsets = [
+        (sc_bounds[i], sc_bounds[i + 1], endpoint_bounds[i], endpoint_bounds[i + 1])
+        for i in range(len(well_fovs))
+        if sc_bounds[i + 1] > sc_bounds[i]
+    ]
+
+    track_coordinates = sc_df[[x_column, y_column]].to_numpy(dtype=np.float64)
+    track_coordinates = np.ascontiguousarray(track_coordinates[sc_order])
+    endpoint_coordinates = endpoint_df[[x_column, y_column]].to_numpy(dtype=np.float64)
+    endpoint_coordinates = np.ascontiguousarray(endpoint_coordinates[endpoint_order])
+
+    if n_workers > 1:
+        endpoint_matches, track_matches = _match_well_fovs_in_parallel(
+            track_coordinates,
+            endpoint_coordinates,
+            well_fov_offsets,
+            distance_threshold=distance_threshold,
+            n_workers=n_workers,
+            n_chunks=n_chunks if n_chunks is not None else 4 * n_workers,
+        )
+    else:
+        endpoint_matches, track_matches = _match_well_fovs(
+            track_coordinates,
+            endpoint_coordinates,
+            well_fov_offsets,
+            distance_threshold=distance_threshold,
+        )
+
+    matched_track_ids = np.full(len(endpoint_df), np.nan, dtype=object)
+    matched_track_ids[endpoint_order[endpoint_matches]] = sc_df[
+        track_id_column
+    ].to_numpy()[sc_order[track_matches]]
+
+    matched_endpoint_df = endpoint_df.copy()
+    matched_endpoint_df[track_id_column] = matched_track_ids
+    return matched_endpoint_df
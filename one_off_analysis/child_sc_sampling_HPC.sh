@@ -1,24 +1,28 @@
 #!/bin/bash
 #SBATCH --nodes=1
 #SBATCH --ntasks=1
+#SBATCH --cpus-per-task=8
 #SBATCH --partition=amilan
 #SBATCH --qos=normal
 #SBATCH --account=amc-general
-#SBATCH --time=00:5:00
-#SBATCH --output=sc_sampling_child-%j.out
+#SBATCH --time=02:00:00
+#SBATCH --output=sc_sampling_child-%A_%a.out
 
 module load miniforge
 conda init bash
 conda activate timelapse_map_env
 
-percent=$1
-seed=$2
+array_size=$1
 
 cd scripts/ || exit
 
-
-python 2.run_map_on_percentages_of_cells.py --percentage $percent --seed $seed --shuffle
-python 2.run_map_on_percentages_of_cells.py --percentage $percent --seed $seed
+# run this array job's share of the seeds, combinations that already have a
+# result are skipped so a resubmitted array resumes where it stopped
+python 2.run_map_on_percentages_of_cells.py \
+    --sweep \
+    --array_index "$SLURM_ARRAY_TASK_ID" \
+    --array_size "$array_size" \
+    --n_workers "$SLURM_CPUS_PER_TASK"
 
 cd .. || exit
 
@@ -4,7 +4,7 @@
 #SBATCH --partition=amilan
 #SBATCH --qos=normal
 #SBATCH --account=amc-general
-#SBATCH --time=24:00:00
+#SBATCH --time=00:10:00
 #SBATCH --output=sc_sampling_parent-%j.out
 
 module load miniforge
@@ -13,21 +13,11 @@ conda activate timelapse_map_env
 
 jupyter nbconvert --to=script --FilesWriter.build_directory=scripts/ notebooks/*.ipynb
 
-# read percentage of parent cells from file
-mapfile -t percentage < ./combinations/percentage.txt
-mapfile -t seeds < ./combinations/seeds.txt
-
-for p in "${percentage[@]}"; do
-    for s in "${seeds[@]}"; do
-            echo "Parent cell sampling: $p, seed: $s"
-            number_of_jobs=$(squeue -u $USER | wc -l)
-            while [ $number_of_jobs -gt 990 ]; do
-                sleep 1s
-                number_of_jobs=$(squeue -u $USER | wc -l)
-            done
-            sbatch child_sc_sampling_HPC.sh $p $s
-    done
-done
+# pack the seeds into one job array, every array job runs all of the percentages of
+# every array_size-th seed on a process pool instead of one job per combination
+array_size=20
+echo "Cell sampling array of $array_size jobs"
+sbatch --array=0-$((array_size - 1)) child_sc_sampling_HPC.sh "$array_size"
 
 conda deactivate
 
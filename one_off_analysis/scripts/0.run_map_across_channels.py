@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[8]:
+# In[ ]:
 
 
+import argparse
+import importlib.metadata
 import pathlib
-import random
 import sys
 import warnings
 
-import numpy as np
 import pandas as pd
 import pycytominer.aggregate
 
@@ -18,7 +18,12 @@ warnings.filterwarnings("ignore", category=RuntimeWarning)
 import itertools
 
 sys.path.append("../utils")
-from mAP_utils import run_mAP_across_time
+from mAP_utils import ChannelGramMatrices, run_mAP_across_time
+
+sys.path.append("../../utils")
+from feature_name_utils import parse_feature_names
+from shuffle_utils import shuffle_columns
+from task_cache_utils import TaskCache, file_fingerprint, task_key
 
 # check if in a jupyter notebook
 try:
@@ -28,6 +33,24 @@ except NameError:
     in_notebook = False
 
 
+# In[ ]:
+
+
+if not in_notebook:
+    # setup the argument parser
+    parser = argparse.ArgumentParser(description="Run mAP across channel combinations")
+    parser.add_argument(
+        "--channel_gram",
+        action="store_true",
+        help="Assemble the similarities of each channel combination from per-channel Gram matrices",
+    )
+    # parse the arguments
+    args = parser.parse_args()
+    channel_gram = args.channel_gram
+else:
+    channel_gram = False
+
+
 # In[9]:
 
 
@@ -69,7 +92,7 @@ print(aggregate_df.shape)
 aggregate_df.head()
 
 
-# In[10]:
+# In[ ]:
 
 
 # get the non metadata columns
@@ -85,52 +108,30 @@ non_feature_cols = (
 correlation_cols = [col for col in features_cols if "Correlation" in col]
 features_cols = [cols for cols in features_cols if cols not in non_feature_cols]
 features_cols = [cols for cols in features_cols if cols not in correlation_cols]
-df = pd.DataFrame(features_cols, columns=["features"])
-
-df[
-    [
-        "Compartment",
-        "Feature_type",
-        "Measurement",
-        "Channel",
-        "misc1",
-        "misc2",
-        "misc3",
-        "misc4",
-        "misc5",
-    ]
-] = df["features"].str.split("_", expand=True)
-# Update Channel column where it contains "CL"
-
-df.loc[df["Channel"].str.contains("CL", na=False), "Channel"] = (
-    df["Channel"] + "_" + df["misc1"]
-)
-# Update Channel column where it contains "CL_488"
-df.loc[df["Channel"].str.contains("CL_488", na=False), "Channel"] = (
-    df["Channel"] + "_" + df["misc2"]
-)
-df.drop(columns=["misc1", "misc2", "misc3", "misc4", "misc5"], inplace=True)
-df.head()
+# look up the channel of each feature from the parsed feature names
+feature_info = parse_feature_names(features_cols)
+feature_info.head()
 
 
-# In[11]:
+# In[ ]:
 
 
 # create a dictionary of loadable features for each channel
 loadable_features = {}
-for channel in df.Channel.unique():
-    channel_df = df.query("Channel == @channel")
-    loadable_features[channel] = channel_df.features.tolist()
+for channel in feature_info["Channel"].unique():
+    loadable_features[channel] = feature_info.index[
+        feature_info["Channel"] == channel
+    ].tolist()
 loadable_features["None"] = non_feature_cols
 loadable_features["All"] = [
     cols for cols in aggregate_df.columns if "Metadata" not in cols
 ]
 
 
-# In[12]:
+# In[ ]:
 
 
-unique_channels = df["Channel"].unique().tolist()
+unique_channels = feature_info["Channel"].unique().tolist()
 # unique_channels = unique_channels + ['None']
 # channel combinations
 channel_combinations = []
@@ -141,45 +142,118 @@ channel_combinations = channel_combinations + [["None"]]
 channel_combinations
 
 
-# In[13]:
+# In[ ]:
 
 
 channel_combo_output_dict = {}
+# the mAP of each channel combination is cached by its inputs, so re-running the
+# sweep only recomputes the combinations whose inputs changed
+task_cache = TaskCache()
+input_fingerprint = file_fingerprint(
+    data_file_path,
+    pathlib.Path(
+        "../../data/CP_feature_select/profiles/features_selected_profile.parquet"
+    ).resolve(strict=True),
+)
+reference_group = aggregate_df["Metadata_dose"].min()
+# the Gram matrices of the channel blocks of each shuffle option, built on first use
+channel_gram_matrices = {}
+# loop through the channel combinations and shuffle
 for shuffle in [False, True]:
     for channel_combination in channel_combinations:
-        features_to_load = []
-        features_to_load.append(metadata_cols)
+        blocks_to_load = []
+        # rename the all channels to all
         if len(channel_combination) == 5:
             channel_combination = ["All"]
         elif channel_combination == ["None"]:
-            features_to_load.append(loadable_features["None"])
-        else:
-            for channel in channel_combination:
-                features_to_load.append(loadable_features[channel])
-            features_to_load.append(loadable_features["None"])
-        features_to_load = list(itertools.chain(*features_to_load))
-        temporary_df = aggregate_df[features_to_load]
-        if shuffle == True:
-            print("shuffled")
-            shuffle_status = "shuffled"
-            random.seed(0)
-            # permutate the data
-            for col in temporary_df.columns:
-                if "Metadata_Time" in col or "Metadata_dose" in col:
-                    continue
-                else:
-                    temporary_df[col] = np.random.permutation(temporary_df[col])
+            blocks_to_load.append("None")
         else:
-            print("not shuffled")
-            shuffle_status = "non_shuffled"
-
-        dict_of_map_dfs = run_mAP_across_time(
-            temporary_df,
+            blocks_to_load.extend(channel_combination)
+            blocks_to_load.append("None")
+        # flatten the list
+        features_to_load = list(
+            itertools.chain(
+                metadata_cols, *[loadable_features[x] for x in blocks_to_load]
+            )
+        )
+        shuffle_status = "shuffled" if shuffle else "non_shuffled"
+        key = task_key(
+            input_fingerprint=input_fingerprint,
+            feature_columns=features_to_load,
+            shuffle=shuffle,
             seed=0,
             time_column="Metadata_Time",
             reference_column_name="Metadata_dose",
-            reference_group=aggregate_df["Metadata_dose"].min(),
+            reference_group=reference_group,
+            channel_gram=channel_gram,
+            copairs_version=importlib.metadata.version("copairs"),
         )
+        df = task_cache.get(key)
+        if df is not None:
+            print(f"cached {'_'.join(channel_combination)} {shuffle_status}")
+            channel_combo_output_dict[
+                f"{'_'.join(channel_combination)}_{shuffle_status}"
+            ] = df
+            continue
+
+        if channel_gram:
+            if shuffle not in channel_gram_matrices:
+                # every channel block is computed once per shuffle option, the
+                # shuffled baseline of a combination is a column subset of the
+                # shuffled baseline of all of the blocks
+                feature_blocks = {
+                    x: loadable_features[x] for x in unique_channels + ["None"]
+                }
+                temporary_df = aggregate_df[
+                    list(itertools.chain(metadata_cols, *feature_blocks.values()))
+                ]
+                if shuffle:
+                    temporary_df = shuffle_columns(
+                        temporary_df,
+                        protected_columns=[
+                            x
+                            for x in temporary_df.columns
+                            if "Metadata_Time" in x or "Metadata_dose" in x
+                        ],
+                        seed=0,
+                    )
+                channel_gram_matrices[shuffle] = ChannelGramMatrices(
+                    temporary_df,
+                    feature_blocks,
+                    time_column="Metadata_Time",
+                    reference_column_name="Metadata_dose",
+                    reference_group=reference_group,
+                )
+            dict_of_map_dfs = channel_gram_matrices[shuffle].run_mAP_across_time(
+                blocks_to_load, seed=0
+            )
+        else:
+            temporary_df = aggregate_df[features_to_load]
+            # shuffle the data
+            if shuffle == True:
+                print("shuffled")
+                # permutate the data
+                temporary_df = shuffle_columns(
+                    temporary_df,
+                    protected_columns=[
+                        x
+                        for x in temporary_df.columns
+                        if "Metadata_Time" in x or "Metadata_dose" in x
+                    ],
+                    seed=0,
+                )
+            else:
+                print("not shuffled")
+
+            # run mAP with the 0 dose as the reference
+            dict_of_map_dfs = run_mAP_across_time(
+                temporary_df,
+                seed=0,
+                time_column="Metadata_Time",
+                reference_column_name="Metadata_dose",
+                reference_group=reference_group,
+            )
+        # concat and rename the columns
         df = pd.concat(dict_of_map_dfs.values(), keys=dict_of_map_dfs.keys())
         df.reset_index(inplace=True)
         df.rename(
@@ -190,6 +264,7 @@ for shuffle in [False, True]:
         )
         df["Channel"] = "_".join(channel_combination)
         df["shuffle"] = shuffle_status
+        task_cache.put(key, df)
         channel_combo_output_dict[
             f"{'_'.join(channel_combination)}_{shuffle_status}"
         ] = df
@@ -202,8 +277,6 @@ final_df = pd.concat(
     channel_combo_output_dict.values(), keys=channel_combo_output_dict.keys()
 )
 final_df.reset_index(inplace=True, drop=True)
-# drop level_0
-# final_df.drop(columns=["level_0"], inplace=True)
 # save the output to a file
 final_df.to_parquet("../results/mAP_across_channels.parquet")
 final_df.head()
@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import argparse
+import os
 import pathlib
-import random
 import sys
+import time
 
-import numpy as np
 import pandas as pd
 
 # check if in a jupyter notebook
@@ -20,17 +20,18 @@ except NameError:
     in_notebook = False
 import warnings
 
-import pycytominer.aggregate
-import tqdm
-
 # Suppress all RuntimeWarnings
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 
 sys.path.append("../utils")
-from mAP_utils import run_mAP_across_time
+from percentage_sweep_utils import (
+    percentage_output_file,
+    run_mAP_on_percentage_of_cells,
+    run_percentage_sweep,
+)
 
-# In[2]:
+# In[ ]:
 
 
 if not in_notebook:
@@ -46,20 +47,49 @@ if not in_notebook:
     parser.add_argument(
         "--shuffle", action="store_true", help="Shuffle the order of the wells"
     )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Run every percentage, seed and shuffle combination in ../combinations",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of cores to run the sweep on",
+    )
+    parser.add_argument(
+        "--array_index",
+        type=int,
+        default=0,
+        help="The index of this job in a job array that splits the sweep seeds",
+    )
+    parser.add_argument(
+        "--array_size",
+        type=int,
+        default=1,
+        help="The number of jobs in the job array that splits the sweep seeds",
+    )
     # parse the arguments
     args = parser.parse_args()
     percentage = args.percentage
     set_seed = args.seed
     shuffle = args.shuffle
+    sweep = args.sweep
+    n_workers = args.n_workers
+    array_index = args.array_index
+    array_size = args.array_size
 else:
     percentage = 0.1
     set_seed = 0
     shuffle = False
+    sweep = False
+    n_workers = os.cpu_count()
+    array_index = 0
+    array_size = 1
 
-output_file = pathlib.Path(
-    f"../results/mAP_cell_percentages/{percentage}_{set_seed}_{shuffle}.parquet"
-)
-output_file.parent.mkdir(exist_ok=True, parents=True)
+output_dir = pathlib.Path("../results/mAP_cell_percentages/")
+output_dir.mkdir(exist_ok=True, parents=True)
 
 
 # In[3]:
@@ -73,78 +103,35 @@ df = pd.read_parquet(data_file_path)
 df.head()
 
 
-# In[4]:
-
-
-random.seed(set_seed)
-subset_df = df.groupby(["Metadata_Time", "Metadata_Well"]).apply(
-    lambda x: x.sample(frac=percentage, random_state=set_seed),
-    include_groups=True,
-)
-subset_df.drop(columns=["Metadata_number_of_singlecells"], inplace=True)
-subset_df.reset_index(drop=True, inplace=True)
-# calculate the number of cells in each well after sampling
-subset_df["Metadata_number_of_singlecells"] = subset_df.groupby(
-    ["Metadata_Time", "Metadata_Well"]
-)["Metadata_Well"].transform("size")
-
-
-# In[5]:
-
-
-subset_df.reset_index(drop=True, inplace=True)
-if shuffle:
-    # permutate the data
-    for col in subset_df.columns:
-        if col == "Metadata_Time":
-            continue
-        if col == "Metadata_dose":
-            continue
-        if col == "Metadata_Well":
-            continue
-        subset_df[col] = np.random.permutation(subset_df[col])
-metadata_cols = [cols for cols in subset_df.columns if "Metadata" in cols]
-features_cols = [cols for cols in subset_df.columns if "Metadata" not in cols]
-features_cols = features_cols
-aggregate_df = pycytominer.aggregate(
-    population_df=subset_df,
-    strata=["Metadata_Well", "Metadata_Time"],
-    features=features_cols,
-    operation="median",
-)
-
-
-# In[6]:
-
-
-metadata_df = subset_df[metadata_cols]
-metadata_df = metadata_df.drop_duplicates(subset=["Metadata_Well", "Metadata_Time"])
-metadata_df = metadata_df.reset_index(drop=True)
-aggregate_df = pd.merge(
-    metadata_df, aggregate_df, on=["Metadata_Well", "Metadata_Time"]
-)
-aggregate_df.head()
-
-
-# In[7]:
-
-
-dict_of_map_dfs = run_mAP_across_time(
-    aggregate_df,
-    seed=set_seed,
-    time_column="Metadata_Time",
-    reference_column_name="Metadata_dose",
-    reference_group=aggregate_df["Metadata_dose"].min(),
-)
-
-
-output_df = pd.concat(dict_of_map_dfs.values(), keys=dict_of_map_dfs.keys())
-output_df.reset_index(inplace=True)
-output_df.rename(columns={"level_0": "Metadata_Time"}, inplace=True)
-# add the percentage of cells to the keys
-output_df["percentage_of_cells"] = percentage
-output_df["seed"] = set_seed
-output_df["shuffle"] = shuffle
-output_df.reset_index(drop=True, inplace=True)
-output_df.to_parquet(output_file)
-output_df.head()
+# In[ ]:
+
+
+if sweep:
+    # run every combination on one process pool that shares the single-cell
+    # table, the combinations that already have a result are skipped
+    with open("../combinations/percentage.txt") as f:
+        percentages = [float(x) for x in f.read().split()]
+    with open("../combinations/seeds.txt") as f:
+        seeds = [int(x) for x in f.read().split()]
+    # each job of a job array runs every array_size-th seed
+    seeds = list(dict.fromkeys(seeds))[array_index::array_size]
+    runtime_df = run_percentage_sweep(
+        df,
+        percentages=percentages,
+        seeds=seeds,
+        output_dir=output_dir,
+        n_workers=n_workers,
+        runtime_log_path=pathlib.Path(
+            "../results/mAP_cell_percentages_runtimes/"
+            f"{array_index}_of_{array_size}_{time.strftime('%Y%m%d_%H%M%S')}.parquet"
+        ),
+    )
+    print(runtime_df["runtime_seconds"].describe())
+else:
+    output_df = run_mAP_on_percentage_of_cells(
+        df, percentage=percentage, seed=set_seed, shuffle=shuffle
+    )
+    output_df.to_parquet(
+        percentage_output_file(output_dir, percentage, set_seed, shuffle)
+    )
+    output_df.head()
@@ -1,19 +1,25 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
+import sys
 
-import pandas as pd
+import pyarrow.parquet as pq
 
-# In[2]:
+sys.path.append("../../utils")
+from data_access_utils import combine_parquet_files
+
+# In[ ]:
 
 
 input_dir = pathlib.Path("../results/mAP_cell_percentages/").resolve(strict=True)
 output_file = pathlib.Path("../results/mAP_cell_percentages.parquet").resolve()
-# get a list of all files in the directory
-df = pd.concat([pd.read_parquet(file) for file in list(input_dir.glob("*"))])
-df.to_parquet(output_file)
-df.head()
+# stream all of the result files in the directory into one compacted file
+combined_metadata = combine_parquet_files(
+    sorted(input_dir.glob("*.parquet")), output_file
+)
+print(combined_metadata)
+pq.ParquetFile(output_file).read_row_group(0).to_pandas().head()
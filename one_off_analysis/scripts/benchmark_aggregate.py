@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# This notebook benchmarks the grouped median aggregation in `utils/aggregate_utils.py` against `pycytominer.aggregate` followed by the metadata merge that `2.run_map_on_percentages_of_cells.ipynb` used, on the full single-cell table.
+# Both aggregate every well and timepoint, and the results are checked to be identical.
+
+# In[ ]:
+
+
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pycytominer.aggregate
+
+sys.path.append("../../utils")
+from aggregate_utils import aggregate_profiles
+
+# First check on a synthetic float32 feature block, with missing values and strata of odd and even size, that the medians and their dtypes are bit-for-bit identical to `pycytominer.aggregate` called directly.
+
+# In[ ]:
+
+
+rng = np.random.default_rng(0)
+n_cells = 5000
+synthetic_features_cols = [f"Cells_Feature_{i}" for i in range(40)]
+synthetic_df = pd.DataFrame(
+    rng.normal(size=(n_cells, len(synthetic_features_cols))).astype(np.float32),
+    columns=synthetic_features_cols,
+)
+synthetic_df = synthetic_df.mask(rng.random(synthetic_df.shape) < 0.05)
+synthetic_df.insert(
+    0, "Metadata_Well", rng.choice(["C-02", "C-03", "D-02", "D-03"], n_cells)
+)
+synthetic_df.insert(1, "Metadata_Time", rng.integers(0, 13, n_cells).astype(float))
+# a feature that is missing in every cell of a well
+synthetic_df.loc[synthetic_df["Metadata_Well"] == "C-02", "Cells_Feature_0"] = np.nan
+
+synthetic_aggregate_df = aggregate_profiles(
+    synthetic_df,
+    strata=["Metadata_Well", "Metadata_Time"],
+    features=synthetic_features_cols,
+    operation="median",
+)
+pycytominer_synthetic_aggregate_df = pycytominer.aggregate(
+    population_df=synthetic_df,
+    strata=["Metadata_Well", "Metadata_Time"],
+    features=synthetic_features_cols,
+    operation="median",
+)
+# pycytominer sorts the strata, aggregate_profiles keeps their first appearance
+synthetic_aggregate_df = synthetic_aggregate_df.sort_values(
+    ["Metadata_Well", "Metadata_Time"]
+).reset_index(drop=True)[pycytominer_synthetic_aggregate_df.columns]
+assert synthetic_aggregate_df.equals(pycytominer_synthetic_aggregate_df)
+
+
+# In[ ]:
+
+
+data_file_path = pathlib.Path(
+    "../../data/CP_feature_select/profiles/features_selected_profile.parquet"
+).resolve(strict=True)
+benchmark_results_path = pathlib.Path(
+    "../results/aggregate_benchmark.parquet"
+).resolve()
+benchmark_results_path.parent.mkdir(parents=True, exist_ok=True)
+
+df = pd.read_parquet(data_file_path)
+strata = ["Metadata_Well", "Metadata_Time"]
+metadata_cols = [cols for cols in df.columns if "Metadata" in cols]
+features_cols = [cols for cols in df.columns if "Metadata" not in cols]
+print(df.shape)
+
+
+# In[ ]:
+
+
+def pycytominer_aggregate(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The pycytominer median aggregation and metadata merge of the cell sampling
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The single-cell profiles
+
+    Returns
+    -------
+    pd.DataFrame
+        The metadata and median features of each well and timepoint
+    """
+    aggregate_df = pycytominer.aggregate(
+        population_df=df,
+        strata=strata,
+        features=features_cols,
+        operation="median",
+    )
+    metadata_df = df[metadata_cols]
+    metadata_df = metadata_df.drop_duplicates(subset=strata)
+    metadata_df = metadata_df.reset_index(drop=True)
+    return pd.merge(metadata_df, aggregate_df, on=strata)
+
+
+# In[ ]:
+
+
+benchmark_results = {
+    "n_cells": [],
+    "n_features": [],
+    "aggregate_profiles_seconds": [],
+    "pycytominer_seconds": [],
+}
+for _ in range(3):
+    start_time = time.perf_counter()
+    new_aggregate_df = aggregate_profiles(
+        df, strata=strata, features=features_cols, operation="median"
+    )
+    aggregate_profiles_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    pycytominer_aggregate_df = pycytominer_aggregate(df)
+    pycytominer_seconds = time.perf_counter() - start_time
+
+    benchmark_results["n_cells"].append(len(df))
+    benchmark_results["n_features"].append(len(features_cols))
+    benchmark_results["aggregate_profiles_seconds"].append(aggregate_profiles_seconds)
+    benchmark_results["pycytominer_seconds"].append(pycytominer_seconds)
+
+
+# In[ ]:
+
+
+benchmark_df = pd.DataFrame.from_dict(benchmark_results)
+benchmark_df["speedup"] = (
+    benchmark_df["pycytominer_seconds"] / benchmark_df["aggregate_profiles_seconds"]
+)
+benchmark_df.to_parquet(benchmark_results_path, index=False)
+benchmark_df
+
+
+# Check that the medians are bit-for-bit identical to pycytominer, with the same rows, columns and dtypes.
+
+# In[ ]:
+
+
+new_aggregate_df = new_aggregate_df[pycytominer_aggregate_df.columns]
+assert new_aggregate_df.equals(pycytominer_aggregate_df)
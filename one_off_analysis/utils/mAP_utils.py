@@ -1,7 +1,14 @@
+import pathlib
+import sys
+
 import numpy as np
 import pandas as pd
-from copairs import map
-from copairs.matching import assign_reference_index
+from copairs import compute, map
+from copairs.map.average_precision import build_rank_lists
+from copairs.matching import assign_reference_index, find_pairs
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "utils"))
+from null_distribution_utils import mean_average_precision
 
 
 def run_mAP_across_time(
@@ -12,7 +19,10 @@ def run_mAP_across_time(
     reference_group: str = "0.0",
 ) -> dict[pd.DataFrame]:
     """
-    Run mAP across timepoints specifies and hardcoded columns for this data
+    Run mAP across timepoints specifies and hardcoded columns for this data.
+    The metadata and features are split once and the average precision of every
+    timepoint is calculated in a single pass by only pairing profiles that share
+    a timepoint.
 
     Parameters
     ----------
@@ -35,44 +45,304 @@ def run_mAP_across_time(
     """
 
     unique_timepoints = df[time_column].unique()
+    reference_col = "Metadata_reference_index"
+    df_activity = assign_reference_index(
+        df,
+        f"{reference_column_name} == {reference_group}",
+        reference_col=reference_col,
+        default_value=-1,
+    )
+    # split the metadata and features once into a contiguous float32 block
+    metadata = df_activity.filter(regex="Metadata")
+    profiles = np.ascontiguousarray(
+        df_activity.filter(regex="^(?!Metadata)").to_numpy(dtype=np.float32)
+    )
+    non_nan_rows = ~np.isnan(profiles).any(axis=1)
+    if not non_nan_rows.all():
+        print(f"Warning: Dropped {(~non_nan_rows).sum()} rows with NaN values")
+    # group the rows by time with a single sort
+    time_order = np.argsort(metadata[time_column].to_numpy(), kind="stable")
+    time_order = time_order[non_nan_rows[time_order]]
+    profiles = profiles[time_order]
+    metadata = metadata.iloc[time_order].reset_index(drop=True)
+
+    # pairs are only made within a timepoint so the ranks match a per timepoint run
+    pos_sameby = [reference_column_name, reference_col]
+    pos_diffby = []
+    neg_sameby = []
+    neg_diffby = [reference_column_name, reference_col]
+    activity_ap = map.average_precision(
+        metadata,
+        profiles,
+        pos_sameby + [time_column],
+        pos_diffby,
+        neg_sameby + [time_column],
+        neg_diffby,
+    )
+    activity_ap = activity_ap.query(f"{reference_column_name} != {reference_group}")
+    return _map_per_timepoint(
+        activity_ap, unique_timepoints, pos_sameby, time_column, seed
+    )
+
+
+def _map_per_timepoint(
+    activity_ap: pd.DataFrame,
+    unique_timepoints: np.ndarray,
+    pos_sameby: list,
+    time_column: str,
+    seed: int,
+) -> dict[pd.DataFrame]:
+    """
+    Calculate the mAP of each timepoint from the average precision of every profile
+
+    Parameters
+    ----------
+    activity_ap : pd.DataFrame
+        The average precision of the non reference profiles of every timepoint
+    unique_timepoints : np.ndarray
+        The timepoints in the order of the returned dictionary
+    pos_sameby : list
+        The columns that define the groups to calculate the mAP of
+    time_column : str
+        The column name for timepoints
+    seed : int
+        Random seed of the null distributions
+
+    Returns
+    -------
+    dict
+        A dictionary of dataframes with the mAP results for each
+        timepoint.
+    """
+    dict_of_ap_dfs = dict(list(activity_ap.groupby(time_column, sort=False)))
+
     dict_of_map_dfs = {}
     for timepoint in unique_timepoints:
-        single_time_df = df.loc[df[time_column] == timepoint]
-        reference_col = "Metadata_reference_index"
-        df_activity = assign_reference_index(
-            single_time_df,
+        if timepoint not in dict_of_ap_dfs:
+            continue
+        # the null distributions are shared across timepoints and calls
+        activity_map = mean_average_precision(
+            dict_of_ap_dfs[timepoint],
+            pos_sameby,
+            null_size=1000000,
+            threshold=0.05,
+            seed=seed,
+        )
+        activity_map["-log10(p-value)"] = -activity_map["corrected_p_value"].apply(
+            np.log10
+        )
+        # flatten the multi-index columns to make it easier to work with
+        dict_of_map_dfs[timepoint] = activity_map
+    return dict_of_map_dfs
+
+
+class ChannelGramMatrices:
+    """
+    Per-channel Gram matrices of the profiles for a sweep over channel
+    combinations. The features of a channel combination are the concatenation of
+    its channel blocks, so the dot products and squared norms of a combination
+    are the sums of those of its blocks. The Gram matrix of each block is
+    calculated once per timepoint and the cosine similarities of every
+    combination are assembled from them instead of from the features.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        An aggregated dataframe with metadata and the features of every block
+    feature_blocks : dict
+        Mapping of block name (e.g. a channel) to its feature columns, the blocks
+        must not share columns
+    time_column : str, optional
+        The column name for timepoints, by default "Metadata_Time"
+    reference_column_name : str, optional
+        The column name for grouping, by default "Metadata_dose"
+    reference_group : str, optional
+        The reference group for the analysis, by default "0.0"
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        feature_blocks: dict,
+        time_column: str = "Metadata_Time",
+        reference_column_name: str = "Metadata_dose",
+        reference_group: str = "0.0",
+    ):
+        self.time_column = time_column
+        self.reference_column_name = reference_column_name
+        self.reference_group = reference_group
+        self.reference_col = "Metadata_reference_index"
+        self.pos_sameby = [reference_column_name, self.reference_col]
+        self.neg_diffby = [reference_column_name, self.reference_col]
+
+        self.unique_timepoints = df[time_column].unique()
+        # group the rows by time with a single sort
+        time_order = np.argsort(df[time_column].to_numpy(), kind="stable")
+        metadata = assign_reference_index(
+            df.filter(regex="Metadata"),
             f"{reference_column_name} == {reference_group}",
-            reference_col=reference_col,
+            reference_col=self.reference_col,
             default_value=-1,
         )
-        pos_sameby = [reference_column_name, reference_col]
-        pos_diffby = []
-        neg_sameby = []
-        neg_diffby = [reference_column_name, reference_col]
-        metadata = df_activity.filter(regex="Metadata")
-        profiles = df_activity.filter(regex="^(?!Metadata)")
-        profile_shape = profiles.shape
-        profiles = profiles.dropna(axis=0)
-        metadata = metadata.loc[profiles.index]
-        if profile_shape[0] != profiles.shape[0]:
-            print(
-                f"Warning: Dropped {profile_shape[0] - profiles.shape[0]} rows with NaN values"
+        self.metadata = metadata.iloc[time_order].reset_index(drop=True)
+
+        # pairs are only made within a timepoint so the ranks match a per timepoint run
+        self.pos_pairs = find_pairs(
+            self.metadata, sameby=self.pos_sameby + [time_column], diffby=[]
+        )
+        self.neg_pairs = find_pairs(
+            self.metadata, sameby=[time_column], diffby=self.neg_diffby
+        )
+        _, time_group, time_counts = np.unique(
+            self.metadata[time_column].to_numpy(),
+            return_inverse=True,
+            return_counts=True,
+        )
+        time_offsets = np.concatenate([[0], np.cumsum(time_counts)])
+
+        # the dot products of the pairs and the squared norms of the rows of
+        # each block, all that the cosine similarities of a combination need
+        self.pos_dots = {}
+        self.neg_dots = {}
+        self.squared_norms = {}
+        self.valid_rows = {}
+        for block_name, feature_columns in feature_blocks.items():
+            values = df[feature_columns].to_numpy(dtype=np.float32)[time_order]
+            gram_matrices = [
+                values[start:stop].astype(np.float64)
+                @ values[start:stop].T.astype(np.float64)
+                for start, stop in zip(time_offsets[:-1], time_offsets[1:])
+            ]
+            self.pos_dots[block_name] = _gram_pair_values(
+                gram_matrices, self.pos_pairs, time_group, time_offsets
+            )
+            self.neg_dots[block_name] = _gram_pair_values(
+                gram_matrices, self.neg_pairs, time_group, time_offsets
+            )
+            self.squared_norms[block_name] = np.concatenate(
+                [np.diagonal(gram_matrix) for gram_matrix in gram_matrices]
             )
-        profiles = profiles.reset_index(drop=True)
-        metadata = metadata.reset_index(drop=True)
-        profiles = profiles.values
+            self.valid_rows[block_name] = ~np.isnan(values).any(axis=1)
 
-        activity_ap = map.average_precision(
-            metadata, profiles, pos_sameby, pos_diffby, neg_sameby, neg_diffby
+    def _cosine_similarities(
+        self, block_names: list, pairs: np.ndarray, pair_dots: dict
+    ) -> np.ndarray:
+        dots = sum((pair_dots[x] for x in block_names), np.zeros(len(pairs)))
+        squared_norms = sum(
+            (self.squared_norms[x] for x in block_names), np.zeros(len(self.metadata))
         )
+        norms = np.sqrt(squared_norms)
+        return (dots / (norms[pairs[:, 0]] * norms[pairs[:, 1]])).astype(np.float32)
+
+    def average_precision(self, block_names: list) -> pd.DataFrame:
+        """
+        Calculate the average precision of every profile on the features of the
+        blocks, matching copairs.map.average_precision on the concatenated features
+
+        Parameters
+        ----------
+        block_names : list
+            The blocks whose features are concatenated
 
-        activity_ap = activity_ap.query(f"{reference_column_name} != {reference_group}")
-        activity_map = map.mean_average_precision(
-            activity_ap, pos_sameby, null_size=1000000, threshold=0.05, seed=seed
+        Returns
+        -------
+        pd.DataFrame
+            The metadata with the average_precision, n_pos_pairs and
+            n_total_pairs of every profile
+        """
+        pos_sims = self._cosine_similarities(block_names, self.pos_pairs, self.pos_dots)
+        neg_sims = self._cosine_similarities(block_names, self.neg_pairs, self.neg_dots)
+        pos_pairs = self.pos_pairs
+        neg_pairs = self.neg_pairs
+        metadata = self.metadata
+
+        # drop the rows with nan in the features of the blocks along with their pairs
+        valid_rows = np.ones(len(self.metadata), dtype=bool)
+        for block_name in block_names:
+            valid_rows &= self.valid_rows[block_name]
+        if not valid_rows.all():
+            print(f"Warning: Dropped {(~valid_rows).sum()} rows with NaN values")
+            new_positions = (np.cumsum(valid_rows) - 1).astype(np.uint32)
+            pos_mask = valid_rows[pos_pairs].all(axis=1)
+            neg_mask = valid_rows[neg_pairs].all(axis=1)
+            pos_pairs, pos_sims = new_positions[pos_pairs[pos_mask]], pos_sims[pos_mask]
+            neg_pairs, neg_sims = new_positions[neg_pairs[neg_mask]], neg_sims[neg_mask]
+            metadata = metadata[valid_rows]
+
+        paired_ix, rel_k_list, counts = build_rank_lists(
+            pos_pairs, neg_pairs, pos_sims, neg_sims
         )
-        activity_map["-log10(p-value)"] = -activity_map["corrected_p_value"].apply(
-            np.log10
+        ap_scores, null_confs = compute.ap_contiguous(rel_k_list, counts)
+        activity_ap = metadata.reset_index(drop=True)
+        activity_ap["n_pos_pairs"] = 0
+        activity_ap["n_total_pairs"] = 0
+        activity_ap.loc[paired_ix, "average_precision"] = ap_scores
+        activity_ap.loc[paired_ix, "n_pos_pairs"] = null_confs[:, 0]
+        activity_ap.loc[paired_ix, "n_total_pairs"] = null_confs[:, 1]
+        return activity_ap
+
+    def run_mAP_across_time(
+        self, block_names: list, seed: int = 0
+    ) -> dict[pd.DataFrame]:
+        """
+        Run mAP across timepoints on the features of the blocks, the same as
+        run_mAP_across_time on the concatenated features of the blocks
+
+        Parameters
+        ----------
+        block_names : list
+            The blocks whose features are concatenated
+        seed : int, optional
+            Random seed for reproducibility, by default 0
+
+        Returns
+        -------
+        dict
+            A dictionary of dataframes with the mAP results for each
+            timepoint.
+        """
+        activity_ap = self.average_precision(block_names).query(
+            f"{self.reference_column_name} != {self.reference_group}"
         )
-        # flatten the multi-index columns to make it easier to work with
-        dict_of_map_dfs[timepoint] = activity_map
-    return dict_of_map_dfs
+        return _map_per_timepoint(
+            activity_ap,
+            self.unique_timepoints,
+            self.pos_sameby,
+            self.time_column,
+            seed,
+        )
+
+
+def _gram_pair_values(
+    gram_matrices: list,
+    pairs: np.ndarray,
+    time_group: np.ndarray,
+    time_offsets: np.ndarray,
+) -> np.ndarray:
+    """
+    Look up the entries of the per timepoint Gram matrices for pairs of rows that
+    share a timepoint
+
+    Parameters
+    ----------
+    gram_matrices : list
+        The Gram matrix of the rows of each timepoint
+    pairs : np.ndarray
+        The (n_pairs, 2) row positions of the pairs
+    time_group : np.ndarray
+        The timepoint position of every row
+    time_offsets : np.ndarray
+        The position of the first row of each timepoint
+
+    Returns
+    -------
+    np.ndarray
+        The Gram matrix entry of each pair
+    """
+    pair_values = np.empty(len(pairs))
+    pair_group = time_group[pairs[:, 0]]
+    for group, gram_matrix in enumerate(gram_matrices):
+        in_group = pair_group == group
+        local_pairs = pairs[in_group].astype(np.intp) - time_offsets[group]
+        pair_values[in_group] = gram_matrix[local_pairs[:, 0], local_pairs[:, 1]]
+    return pair_values
@@ -0,0 +1,470 @@
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import tqdm
+from threadpoolctl import threadpool_limits
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "utils"))
+from aggregate_utils import aggregate_profiles
+from shuffle_utils import shuffle_columns
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parent))
+from mAP_utils import run_mAP_across_time
+
+# the single-cell table attached once in each worker process
+_shared_cells = {}
+
+
+class NestedCellSampler:
+    """
+    Sample percentages of the cells of every group (e.g. well and timepoint) from
+    one random rank per cell. The p% subsample of a group is the cells ranked
+    below p% of the group size, so one seed ranks the cells once for every
+    percentage and the subsamples of a seed are nested.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The single-cell profiles
+    group_columns : list, optional
+        The columns that define the groups to sample from, by default None
+        (["Metadata_Time", "Metadata_Well"])
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        group_columns: list = None,
+    ):
+        if group_columns is None:
+            group_columns = ["Metadata_Time", "Metadata_Well"]
+        group_codes = (
+            df.groupby(group_columns, sort=True)
+            .ngroup()
+            .fillna(-1)
+            .to_numpy(dtype=np.intp)
+        )
+        n_groups = group_codes.max() + 1 if len(group_codes) > 0 else 0
+        # the cells with a missing group key are never sampled, as in a groupby
+        group_codes[group_codes < 0] = n_groups
+        self.group_codes = group_codes
+        self.group_sizes = np.bincount(group_codes, minlength=n_groups + 1)
+        self.group_sizes[n_groups] = 0
+        self.group_offsets = np.concatenate([[0], np.cumsum(self.group_sizes)[:-1]])
+
+    def ranks(self, seed: int) -> np.ndarray:
+        """
+        Randomly rank the cells within their group with a single sort of the
+        whole table
+
+        Parameters
+        ----------
+        seed : int
+            Random seed of the ranks
+
+        Returns
+        -------
+        np.ndarray
+            The rank of every cell within its group
+        """
+        random_keys = np.random.default_rng(seed).random(len(self.group_codes))
+        order = np.lexsort((random_keys, self.group_codes))
+        ranks = np.empty(len(order), dtype=np.intp)
+        ranks[order] = (
+            np.arange(len(order)) - self.group_offsets[self.group_codes[order]]
+        )
+        return ranks
+
+    def sample(self, percentage: float, ranks: np.ndarray) -> np.ndarray:
+        """
+        Take the cells ranked below the percentage of their group size
+
+        Parameters
+        ----------
+        percentage : float
+            The fraction of the cells of each group to sample, the number of
+            cells is rounded as in pd.DataFrame.sample(frac=percentage)
+        ranks : np.ndarray
+            The ranks of the cells from ranks()
+
+        Returns
+        -------
+        np.ndarray
+            The row positions of the sampled cells, by group and then by rank
+        """
+        cutoffs = np.round(percentage * self.group_sizes)
+        rows = np.flatnonzero(ranks < cutoffs[self.group_codes])
+        return rows[np.lexsort((ranks[rows], self.group_codes[rows]))]
+
+
+def run_mAP_on_percentage_of_cells(
+    df: pd.DataFrame,
+    percentage: float,
+    seed: int,
+    shuffle: bool,
+    sampler: NestedCellSampler = None,
+    ranks: np.ndarray = None,
+) -> pd.DataFrame:
+    """
+    Sample a percentage of the cells of every well and timepoint, aggregate them
+    to well profiles and calculate the mAP of every timepoint
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The single-cell profiles with metadata and features
+    percentage : float
+        The fraction of the cells of each well and timepoint to sample
+    seed : int
+        Random seed of the sampling, the shuffled baseline and the null
+        distributions
+    shuffle : bool
+        Whether to calculate the mAP of the shuffled baseline
+    sampler : NestedCellSampler, optional
+        The sampler of the wells and timepoints of df, by default None (built
+        from df)
+    ranks : np.ndarray, optional
+        The ranks of the cells for the seed, by default None (ranked with the
+        seed), pass them to sample every percentage of a seed from one ranking
+
+    Returns
+    -------
+    pd.DataFrame
+        The mAP of every timepoint with the percentage_of_cells, seed and shuffle
+        columns
+    """
+    sampler = sampler if sampler is not None else NestedCellSampler(df)
+    ranks = ranks if ranks is not None else sampler.ranks(seed)
+    subset_df = (
+        df.iloc[sampler.sample(percentage, ranks)]
+        .drop(columns=["Metadata_number_of_singlecells"])
+        .reset_index(drop=True)
+    )
+    # calculate the number of cells in each well after sampling
+    subset_df["Metadata_number_of_singlecells"] = subset_df.groupby(
+        ["Metadata_Time", "Metadata_Well"]
+    )["Metadata_Well"].transform("size")
+
+    if shuffle:
+        # permutate the data
+        subset_df = shuffle_columns(
+            subset_df,
+            protected_columns=["Metadata_Time", "Metadata_dose", "Metadata_Well"],
+            seed=seed,
+        )
+    features_cols = [cols for cols in subset_df.columns if "Metadata" not in cols]
+    # the median profile of each well and timepoint with the metadata of its
+    # first cell
+    aggregate_df = aggregate_profiles(
+        subset_df,
+        strata=["Metadata_Well", "Metadata_Time"],
+        features=features_cols,
+        operation="median",
+    )
+
+    dict_of_map_dfs = run_mAP_across_time(
+        aggregate_df,
+        seed=seed,
+        time_column="Metadata_Time",
+        reference_column_name="Metadata_dose",
+        reference_group=aggregate_df["Metadata_dose"].min(),
+    )
+    output_df = pd.concat(dict_of_map_dfs.values(), keys=dict_of_map_dfs.keys())
+    output_df.reset_index(inplace=True)
+    output_df.rename(columns={"level_0": "Metadata_Time"}, inplace=True)
+    # add the percentage of cells to the keys
+    output_df["percentage_of_cells"] = percentage
+    output_df["seed"] = seed
+    output_df["shuffle"] = shuffle
+    output_df.reset_index(drop=True, inplace=True)
+    return output_df
+
+
+def percentage_output_file(
+    output_dir: pathlib.Path, percentage: float, seed: int, shuffle: bool
+) -> pathlib.Path:
+    """
+    The result file of one percentage, seed and shuffle combination
+
+    Parameters
+    ----------
+    output_dir : pathlib.Path
+        The directory of the results
+    percentage : float
+        The fraction of the cells sampled
+    seed : int
+        Random seed of the combination
+    shuffle : bool
+        Whether the combination is the shuffled baseline
+
+    Returns
+    -------
+    pathlib.Path
+        The path of the result file
+    """
+    return pathlib.Path(output_dir) / f"{percentage}_{seed}_{shuffle}.parquet"
+
+
+def _attach_shared_cells(
+    shared_memory_name: str,
+    shape: tuple,
+    dtype: np.dtype,
+    metadata: pd.DataFrame,
+    feature_columns: list,
+    columns: list,
+) -> None:
+    """
+    Pool initializer that rebuilds the single-cell table around the feature
+    matrix in shared memory, so that the features are not copied into every
+    worker
+
+    Parameters
+    ----------
+    shared_memory_name : str
+        The name of the shared memory block with the feature matrix
+    shape : tuple
+        The (n_cells, n_features) shape of the feature matrix
+    dtype : np.dtype
+        The dtype of the feature matrix
+    metadata : pd.DataFrame
+        The metadata of the cells
+    feature_columns : list
+        The feature columns of the feature matrix
+    columns : list
+        The column order of the single-cell table
+    """
+    shared_block = shared_memory.SharedMemory(name=shared_memory_name)
+    features = np.ndarray(shape, dtype=dtype, buffer=shared_block.buf)
+    features.flags.writeable = False
+    df = pd.DataFrame(features, columns=feature_columns, copy=False)
+    # the metadata is inserted in column order, concatenating would copy the
+    # features to consolidate them with it
+    for i, column in enumerate(columns):
+        if column in metadata.columns:
+            df.insert(i, column, metadata[column].to_numpy())
+    _shared_cells["shared_block"] = shared_block
+    _shared_cells["df"] = df
+    _shared_cells["sampler"] = NestedCellSampler(df)
+    threadpool_limits(limits=1)
+
+
+def _run_seed_task(task: dict) -> list[dict]:
+    """
+    Calculate the mAP of the percentage and shuffle combinations of one seed on
+    the single-cell table attached by _attach_shared_cells and write each to its
+    result file. The cells are ranked once for all of the percentages and the
+    combinations that already have a result file (e.g. from a failed attempt)
+    are skipped.
+
+    Parameters
+    ----------
+    task : dict
+        The seed, attempt and the percentage, shuffle and output_file of its
+        combinations
+
+    Returns
+    -------
+    list[dict]
+        The percentage, seed, shuffle, attempt, runtime_seconds and output_file
+        of every combination calculated
+    """
+    ranks = _shared_cells["sampler"].ranks(task["seed"])
+    runtime_records = []
+    for combination in task["combinations"]:
+        output_file = combination["output_file"]
+        if output_file.exists():
+            continue
+        start_time = time.perf_counter()
+        output_df = run_mAP_on_percentage_of_cells(
+            _shared_cells["df"],
+            percentage=combination["percentage"],
+            seed=task["seed"],
+            shuffle=combination["shuffle"],
+            sampler=_shared_cells["sampler"],
+            ranks=ranks,
+        )
+        # write outside of the results directory and move into place, so an
+        # interrupted sweep never leaves a partial result file that would be
+        # skipped on resume or picked up when the results are combined
+        tmp_file = output_file.parent.parent / f".{output_file.name}.tmp"
+        output_df.to_parquet(tmp_file)
+        os.replace(tmp_file, output_file)
+        runtime_records.append(
+            {
+                "percentage": combination["percentage"],
+                "seed": task["seed"],
+                "shuffle": combination["shuffle"],
+                "attempt": task["attempt"],
+                "runtime_seconds": time.perf_counter() - start_time,
+                "output_file": str(output_file),
+            }
+        )
+    return runtime_records
+
+
+def run_percentage_sweep(
+    df: pd.DataFrame,
+    percentages: list,
+    seeds: list,
+    output_dir: pathlib.Path,
+    shuffle_options: list = (False, True),
+    n_workers: int = None,
+    max_retries: int = 2,
+    runtime_log_path: pathlib.Path = None,
+) -> pd.DataFrame:
+    """
+    Calculate the mAP of every percentage x seed x shuffle combination on a
+    process pool in a single run. The single-cell table is loaded once and its
+    feature matrix is shared with the workers read-only. Each seed is one task
+    that ranks the cells once and samples every percentage from the ranks.
+    Every result is written as soon as it finishes and the combinations that
+    already have a result file are skipped, so an interrupted sweep resumes
+    where it stopped. The failed tasks are retried on a new pool, so a worker
+    that crashed (e.g. out of memory) is retried as well.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The single-cell profiles with metadata and features
+    percentages : list
+        The fractions of the cells to sample
+    seeds : list
+        The random seeds to sample each percentage with
+    output_dir : pathlib.Path
+        The directory to write the result of each combination to
+    shuffle_options : list, optional
+        Whether to calculate the mAP of the profiles (False) and of the shuffled
+        baseline (True), by default (False, True)
+    n_workers : int, optional
+        The number of worker processes (the core budget), by default None
+        (os.cpu_count())
+    max_retries : int, optional
+        The number of times a failed task is retried, by default 2
+    runtime_log_path : pathlib.Path, optional
+        The parquet file to write the runtime of every combination to, by
+        default None (not written)
+
+    Returns
+    -------
+    pd.DataFrame
+        The percentage, seed, shuffle, attempt, runtime_seconds and output_file
+        of every combination calculated by the tasks that finished in this run
+
+    Raises
+    ------
+    RuntimeError
+        If some tasks still fail after max_retries retries, the results of the
+        other tasks are kept
+    """
+    n_workers = n_workers if n_workers is not None else os.cpu_count()
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    tasks = []
+    n_combinations = 0
+    n_pending = 0
+    # the combination files may repeat a value, each combination is run once
+    for seed in dict.fromkeys(seeds):
+        combinations = []
+        for percentage in dict.fromkeys(percentages):
+            for shuffle in shuffle_options:
+                n_combinations += 1
+                output_file = percentage_output_file(
+                    output_dir, percentage, seed, shuffle
+                )
+                if output_file.exists():
+                    continue
+                combinations.append(
+                    {
+                        "percentage": percentage,
+                        "shuffle": shuffle,
+                        "output_file": output_file,
+                    }
+                )
+        if len(combinations) > 0:
+            tasks.append({"seed": seed, "attempt": 0, "combinations": combinations})
+            n_pending += len(combinations)
+    print(f"{n_combinations - n_pending} of {n_combinations} combinations are done")
+
+    runtime_records = []
+    failed_tasks = {}
+    if len(tasks) > 0:
+        metadata_columns = [x for x in df.columns if "Metadata" in x]
+        feature_columns = [x for x in df.columns if "Metadata" not in x]
+        features = df[feature_columns].to_numpy()
+        shared_block = shared_memory.SharedMemory(
+            create=True, size=max(features.nbytes, 1)
+        )
+        try:
+            shared_features = np.ndarray(
+                features.shape, dtype=features.dtype, buffer=shared_block.buf
+            )
+            shared_features[:] = features
+            shape, dtype = features.shape, features.dtype
+            del features, shared_features
+            for attempt in range(max_retries + 1):
+                if attempt > 0:
+                    print(f"retrying {len(tasks)} failed tasks, attempt {attempt}")
+                failed_tasks = {}
+                # every attempt gets a new pool so a crashed worker does not
+                # fail the retries, the workers are forked as the sweep script
+                # has no __main__ guard for spawned workers to import
+                with ProcessPoolExecutor(
+                    max_workers=n_workers,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_attach_shared_cells,
+                    initargs=(
+                        shared_block.name,
+                        shape,
+                        dtype,
+                        df[metadata_columns],
+                        feature_columns,
+                        list(df.columns),
+                    ),
+                ) as executor:
+                    futures = {
+                        executor.submit(
+                            _run_seed_task, {**task, "attempt": attempt}
+                        ): task
+                        for task in tasks
+                    }
+                    for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                        try:
+                            runtime_records.extend(future.result())
+                        except Exception as error:
+                            failed_tasks[futures[future]["seed"]] = error
+                tasks = [x for x in tasks if x["seed"] in failed_tasks]
+                if len(tasks) == 0:
+                    break
+        finally:
+            shared_block.close()
+            shared_block.unlink()
+
+    runtime_df = pd.DataFrame(
+        runtime_records,
+        columns=[
+            "percentage",
+            "seed",
+            "shuffle",
+            "attempt",
+            "runtime_seconds",
+            "output_file",
+        ],
+    )
+    if runtime_log_path is not None:
+        runtime_log_path = pathlib.Path(runtime_log_path)
+        runtime_log_path.parent.mkdir(parents=True, exist_ok=True)
+        runtime_df.to_parquet(runtime_log_path, index=False)
+    if len(failed_tasks) > 0:
+        raise RuntimeError(
+            f"{len(failed_tasks)} seeds failed after {max_retries} retries: "
+            + ", ".join(f"{seed} ({error!r})" for seed, error in failed_tasks.items())
+        )
+    return runtime_df
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+
+def _segment_medians(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """
+    Calculate the nan-skipping median of every column of each segment of rows
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The (n_rows, n_columns) float64 values sorted by segment
+    starts : np.ndarray
+        The first row of each segment
+
+    Returns
+    -------
+    np.ndarray
+        The (n_segments, n_columns) float64 medians
+    """
+    stops = np.append(starts[1:], len(values))
+    column_positions = np.arange(values.shape[1])
+    medians = np.empty((len(starts), values.shape[1]), dtype=np.float64)
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        # the nans are sorted to the end of each column
+        segment = np.sort(values[start:stop], axis=0)
+        n_valid = stop - start - np.isnan(segment).sum(axis=0)
+        lower = segment[np.maximum((n_valid - 1) // 2, 0), column_positions]
+        upper = segment[n_valid // 2 - (n_valid == 0), column_positions]
+        # the two middle values are averaged as pandas does
+        medians[i] = (lower + upper) / 2
+        medians[i, n_valid == 0] = np.nan
+    return medians
+
+
+def _segment_means(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """
+    Calculate the nan-skipping mean of every column of each segment of rows
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The (n_rows, n_columns) float64 values sorted by segment
+    starts : np.ndarray
+        The first row of each segment
+
+    Returns
+    -------
+    np.ndarray
+        The (n_segments, n_columns) float64 means
+    """
+    is_valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(is_valid, values, 0), starts)
+    counts = np.add.reduceat(is_valid, starts, dtype=np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def aggregate_profiles(
+    df: pd.DataFrame,
+    strata: list,
+    features: list = None,
+    operation: str = "median",
+) -> pd.DataFrame:
+    """
+    Aggregate single-cell profiles to one profile per stratum, e.g. per well and
+    timepoint. The rows are sorted once by their integer coded stratum and the
+    median (or mean) of the feature block is calculated per contiguous segment.
+    Like pycytominer.aggregate, which casts the features to float64 and takes
+    the pandas groupby median, the features are aggregated and returned as
+    float64, so the medians are identical to pycytominer for float32 features
+    too. The metadata of each stratum is taken from its first row, so the
+    result already has the metadata that would otherwise be merged back in.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The single-cell profiles
+    strata : list
+        The columns that define the profiles to aggregate together
+    features : list, optional
+        The feature columns to aggregate, by default None (every column without
+        "Metadata" in its name)
+    operation : str, optional
+        The aggregation, "median" or "mean", by default "median"
+
+    Returns
+    -------
+    pd.DataFrame
+        The metadata and aggregated features of each stratum, in the order that
+        the strata first appear in df
+    """
+    if operation not in ("median", "mean"):
+        raise ValueError(f"operation must be 'median' or 'mean', not {operation}")
+    if features is None:
+        features = [x for x in df.columns if "Metadata" not in x]
+    metadata_columns = [x for x in df.columns if x not in set(features)]
+
+    # missing strata form their own stratum, as in the dropna=False groupby of
+    # pycytominer
+    stratum_codes = (
+        df.groupby(strata, sort=False, dropna=False).ngroup().to_numpy(dtype=np.intp)
+    )
+    order = np.argsort(stratum_codes, kind="stable")
+    starts = np.flatnonzero(np.diff(stratum_codes[order], prepend=-1))
+
+    values = df[features].to_numpy(dtype=np.float64)[order]
+    if operation == "median":
+        aggregated = _segment_medians(values, starts)
+    else:
+        aggregated = _segment_means(values, starts)
+
+    metadata_df = df[metadata_columns].iloc[order[starts]].reset_index(drop=True)
+    feature_df = pd.DataFrame(aggregated, columns=features)
+    return pd.concat([metadata_df, feature_df], axis=1)
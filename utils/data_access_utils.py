@@ -0,0 +1,389 @@
+import functools
+import operator
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+def _get_index_columns(schema: pa.Schema) -> list:
+    """
+    Get the columns that pandas stored the dataframe index in
+    """
+    pandas_metadata = schema.pandas_metadata or {}
+    return [x for x in pandas_metadata.get("index_columns", []) if isinstance(x, str)]
+
+
+def _split_feature_set_columns(schema: pa.Schema) -> dict[str, list]:
+    """
+    Split the columns of a profile parquet schema into metadata and feature sets
+    """
+    index_columns = _get_index_columns(schema)
+    column_names = [x for x in schema.names if x not in index_columns]
+    metadata_columns = [x for x in column_names if "Metadata" in x]
+    scDINO_columns = [
+        x for x in column_names if "scDINO" in x and x not in metadata_columns
+    ]
+    CP_columns = [
+        x for x in column_names if x not in metadata_columns and x not in scDINO_columns
+    ]
+    CP_scDINO_columns = [x for x in column_names if x not in metadata_columns]
+    return {
+        "Metadata": metadata_columns,
+        "scDINO": scDINO_columns,
+        "CP": CP_columns,
+        "CP_scDINO": CP_scDINO_columns,
+    }
+
+
+def get_feature_set_columns(profile_file_path: pathlib.Path) -> dict[str, list]:
+    """
+    Split the columns of a profile parquet file into metadata and feature sets
+    using only the parquet schema, without reading any data
+
+    Parameters
+    ----------
+    profile_file_path : pathlib.Path
+        The path to the profile parquet file
+
+    Returns
+    -------
+    dict[str, list]
+        The "Metadata", "scDINO", "CP" and "CP_scDINO" column names in file order
+    """
+    return _split_feature_set_columns(pq.read_schema(profile_file_path))
+
+
+def _columns_to_load(
+    schema: pa.Schema, feature_set: str = None, metadata_columns: list = None
+) -> list:
+    """
+    Get the columns of a profile parquet schema to load in file order, the pandas
+    index is always loaded so that it is restored like pd.read_parquet
+    """
+    feature_set_columns = _split_feature_set_columns(schema)
+    if metadata_columns is None:
+        metadata_columns = feature_set_columns["Metadata"]
+    columns_to_load = set(metadata_columns + _get_index_columns(schema))
+    if feature_set is not None:
+        columns_to_load.update(feature_set_columns[feature_set])
+    return [x for x in schema.names if x in columns_to_load]
+
+
+def _isin_filter(schema: pa.Schema, column: str, values: list) -> pc.Expression:
+    """
+    Build an isin filter with the values cast to the column type of the file.
+    Float values are matched with equalities instead, as pyarrow skips the row
+    groups whose minimum statistic is the -0.0 that parquet writes for 0.0 when
+    pruning an isin filter.
+    """
+    values = pa.array(list(values)).cast(schema.field(column).type)
+    if pa.types.is_floating(values.type):
+        return functools.reduce(
+            operator.or_, (pc.field(column) == x for x in values), pc.scalar(False)
+        )
+    return pc.field(column).isin(values)
+
+
+def load_profiles(
+    profile_file_path: pathlib.Path,
+    feature_set: str = "CP_scDINO",
+    metadata_columns: list = None,
+    timepoints: list = None,
+    wells: list = None,
+    time_column: str = "Metadata_Time",
+    well_column: str = "Metadata_Well",
+) -> pd.DataFrame:
+    """
+    Load only the requested columns and rows of a profile parquet file.
+    The columns are projected and the timepoint and well filters are pushed down
+    to pyarrow so that row groups that do not match are never read.
+
+    Parameters
+    ----------
+    profile_file_path : pathlib.Path
+        The path to the profile parquet file
+    feature_set : str, optional
+        The feature set to load, one of "scDINO", "CP" or "CP_scDINO",
+        by default "CP_scDINO". If None only metadata columns are loaded.
+    metadata_columns : list, optional
+        The metadata columns to load, by default None which loads all of them
+    timepoints : list, optional
+        Only load the rows of these timepoints, by default None (all timepoints)
+    wells : list, optional
+        Only load the rows of these wells, by default None (all wells)
+    time_column : str, optional
+        The column name for timepoints, by default "Metadata_Time"
+    well_column : str, optional
+        The column name for wells, by default "Metadata_Well"
+
+    Returns
+    -------
+    pd.DataFrame
+        The profiles with the requested columns in file order
+    """
+    schema = pq.read_schema(profile_file_path)
+    filters = None
+    for column, values in ((time_column, timepoints), (well_column, wells)):
+        if values is None:
+            continue
+        column_filter = _isin_filter(schema, column, values)
+        filters = column_filter if filters is None else filters & column_filter
+
+    table = pq.read_table(
+        profile_file_path,
+        columns=_columns_to_load(schema, feature_set, metadata_columns),
+        filters=filters,
+    )
+    return table.to_pandas()
+
+
+def _row_group_time_minimums(
+    parquet_file: pq.ParquetFile, time_column: str
+) -> np.ndarray:
+    """
+    Get the minimum timepoint of each row group from its statistics, inf for the
+    row groups without timepoints and -inf for the row groups without statistics
+    """
+    metadata = parquet_file.metadata
+    time_column_index = parquet_file.schema.names.index(time_column)
+    row_group_minimums = np.full(metadata.num_row_groups, -np.inf)
+    for i in range(metadata.num_row_groups):
+        column_metadata = metadata.row_group(i).column(time_column_index)
+        statistics = column_metadata.statistics
+        if statistics is None:
+            continue
+        if statistics.has_min_max:
+            row_group_minimums[i] = statistics.min
+        elif statistics.has_null_count and (
+            statistics.null_count == column_metadata.num_values
+        ):
+            row_group_minimums[i] = np.inf
+    return row_group_minimums
+
+
+def iter_profile_batches(
+    profile_file_path: pathlib.Path,
+    feature_set: str = "CP_scDINO",
+    metadata_columns: list = None,
+    time_column: str = "Metadata_Time",
+):
+    """
+    Iterate over the profiles of a profile parquet file one timepoint at a time.
+    Every row group is read once, with only the requested columns, and its rows
+    are buffered by timepoint. A timepoint is yielded as soon as the row group
+    statistics show that no unread row group can hold it, so when the file is
+    sorted by time (see sort_by_time) only about one timepoint is in memory at a
+    time. Otherwise timepoints are held until the row groups that overlap them
+    are read, at worst until the end of the file.
+
+    Parameters
+    ----------
+    profile_file_path : pathlib.Path
+        The path to the profile parquet file
+    feature_set : str, optional
+        The feature set to load, one of "scDINO", "CP" or "CP_scDINO",
+        by default "CP_scDINO". If None only metadata columns are loaded.
+    metadata_columns : list, optional
+        The metadata columns to load, by default None which loads all of them
+    time_column : str, optional
+        The column name for timepoints, by default "Metadata_Time"
+
+    Yields
+    ------
+    tuple
+        The timepoint and a pd.DataFrame of its profiles, in sorted timepoint order
+    """
+    parquet_file = pq.ParquetFile(profile_file_path)
+    columns = _columns_to_load(parquet_file.schema_arrow, feature_set, metadata_columns)
+    # the timepoints are read even if they are not requested
+    dropped_columns = [] if time_column in columns else [time_column]
+    columns = [
+        x for x in parquet_file.schema_arrow.names if x in {*columns, time_column}
+    ]
+    row_group_minimums = _row_group_time_minimums(parquet_file, time_column)
+    # the smallest timepoint that a row group from i onwards can still hold
+    remaining_minimums = np.append(
+        np.minimum.accumulate(row_group_minimums[::-1])[::-1], np.inf
+    )
+
+    buffered_tables = {}
+    for i in range(parquet_file.metadata.num_row_groups):
+        table = parquet_file.read_row_group(i, columns=columns)
+        table = table.filter(pc.is_valid(table[time_column]))
+        times = table[time_column].to_numpy()
+        order = np.argsort(times, kind="stable")
+        timepoints, starts = np.unique(times[order], return_index=True)
+        table = table.take(order).drop_columns(dropped_columns)
+        for timepoint, start, stop in zip(
+            timepoints.tolist(), starts, np.append(starts[1:], len(times))
+        ):
+            buffered_tables.setdefault(timepoint, []).append(
+                table.slice(start, stop - start)
+            )
+        for timepoint in sorted(buffered_tables):
+            if timepoint >= remaining_minimums[i + 1]:
+                break
+            yield timepoint, pa.concat_tables(
+                buffered_tables.pop(timepoint)
+            ).to_pandas()
+
+
+class TimepointIndex:
+    """
+    Row positions of a table grouped by timepoint. The timepoints are sorted once
+    and every timepoint is a contiguous range of the sort order, so selecting a
+    timepoint costs O(rows of the timepoint) instead of a boolean mask over the
+    whole table. When the table is already sorted by time (see sort_by_time)
+    the timepoints are selected with slices, which do not copy the feature block.
+
+    Parameters
+    ----------
+    times : pd.Series | np.ndarray
+        The timepoint of each row of the table
+    """
+
+    def __init__(self, times: pd.Series | np.ndarray):
+        times = np.asarray(times)
+        self.order = np.argsort(times, kind="stable")
+        self.timepoints, starts = np.unique(times[self.order], return_index=True)
+        self.offsets = np.append(starts, len(times))
+        self.is_sorted = bool(np.all(self.order == np.arange(len(times))))
+        self._timepoint_positions = {
+            timepoint: i for i, timepoint in enumerate(self.timepoints.tolist())
+        }
+
+    def __len__(self) -> int:
+        return len(self.timepoints)
+
+    def __iter__(self):
+        return iter(self.timepoints.tolist())
+
+    def rows(self, timepoint) -> slice | np.ndarray:
+        """
+        Get the row positions of a timepoint
+
+        Parameters
+        ----------
+        timepoint
+            The timepoint to get the rows of
+
+        Returns
+        -------
+        slice | np.ndarray
+            A slice if the table is sorted by time, otherwise the row positions
+        """
+        i = self._timepoint_positions[timepoint]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        if self.is_sorted:
+            return slice(start, stop)
+        return self.order[start:stop]
+
+    def size(self, timepoint) -> int:
+        """
+        Get the number of rows of a timepoint
+
+        Parameters
+        ----------
+        timepoint
+            The timepoint to count the rows of
+
+        Returns
+        -------
+        int
+            The number of rows of the timepoint
+        """
+        i = self._timepoint_positions[timepoint]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+
+def sort_by_time(
+    df: pd.DataFrame, time_column: str = "Metadata_Time"
+) -> tuple[pd.DataFrame, TimepointIndex]:
+    """
+    Sort a table by time once (stable, so the row order within a timepoint is
+    kept) so that every timepoint is a zero-copy slice of it
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The table to sort
+    time_column : str, optional
+        The column name for timepoints, by default "Metadata_Time"
+
+    Returns
+    -------
+    tuple[pd.DataFrame, TimepointIndex]
+        The sorted table and its timepoint index
+    """
+    timepoint_index = TimepointIndex(df[time_column])
+    if not timepoint_index.is_sorted:
+        df = df.iloc[timepoint_index.order]
+        timepoint_index = TimepointIndex(df[time_column])
+    return df, timepoint_index
+
+
+def combine_parquet_files(
+    file_paths: list[pathlib.Path],
+    output_file_path: pathlib.Path,
+    row_group_size: int = 1000000,
+    compression: str = "zstd",
+) -> pq.FileMetaData:
+    """
+    Combine many small parquet files into one compacted parquet file without
+    loading them into memory. The schemas of the files are read on a thread pool
+    and unified (columns missing from a file are filled with nulls and numeric
+    types are promoted), then the files are scanned as one pyarrow dataset with
+    threaded reads and streamed to the output in row groups of row_group_size.
+
+    Parameters
+    ----------
+    file_paths : list[pathlib.Path]
+        The parquet files to combine, in the row order of the output
+    output_file_path : pathlib.Path
+        The path of the combined parquet file
+    row_group_size : int, optional
+        The number of rows of each row group of the output, by default 1000000
+    compression : str, optional
+        The compression codec of the output, by default "zstd"
+
+    Returns
+    -------
+    pq.FileMetaData
+        The metadata of the combined parquet file
+    """
+    file_paths = [str(x) for x in file_paths]
+    if len(file_paths) == 0:
+        raise ValueError("there are no parquet files to combine")
+    with ThreadPoolExecutor() as executor:
+        schemas = list(executor.map(pq.read_schema, file_paths))
+    # the pandas metadata of a single file does not describe the combined table
+    schema = pa.unify_schemas(schemas, promote_options="permissive").remove_metadata()
+    dataset = ds.dataset(file_paths, schema=schema, format="parquet")
+
+    with pq.ParquetWriter(output_file_path, schema, compression=compression) as writer:
+        batches = []
+        n_buffered_rows = 0
+        for batch in dataset.to_batches(use_threads=True):
+            batches.append(batch)
+            n_buffered_rows += batch.num_rows
+            # small files are buffered so every row group but the last is full
+            if n_buffered_rows >= row_group_size:
+                buffered_table = pa.Table.from_batches(batches, schema=schema)
+                n_full_rows = n_buffered_rows - n_buffered_rows % row_group_size
+                writer.write_table(
+                    buffered_table.slice(0, n_full_rows), row_group_size=row_group_size
+                )
+                batches = buffered_table.slice(n_full_rows).to_batches()
+                n_buffered_rows -= n_full_rows
+        if n_buffered_rows > 0:
+            writer.write_table(
+                pa.Table.from_batches(batches, schema=schema),
+                row_group_size=row_group_size,
+            )
+    return pq.read_metadata(output_file_path)
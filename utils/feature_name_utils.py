@@ -0,0 +1,116 @@
+import functools
+
+import pandas as pd
+
+# the channel names as they appear (split on "_") in the CellProfiler feature names
+CHANNELS = ("CL_488_1", "CL_488_2", "CL_561", "DNA", "AnnexinV")
+# the channel prefixes of the scDINO feature names
+SCDINO_CHANNELS = {
+    "488-1": "CL_488_1",
+    "488-2": "CL_488_2",
+    "561": "CL_561",
+    "DNA": "DNA",
+}
+# readable channel names for figures
+CHANNEL_LABELS = {
+    "CL_488_1": "CL 488-1",
+    "CL_488_2": "CL 488-2",
+    "CL_561": "CL 561",
+}
+FEATURIZERS = ("CP", "scDINO")
+FEATURE_INFO_COLUMNS = [
+    "Compartment",
+    "Feature_type",
+    "Measurement",
+    "Channel",
+    "Channel2",
+    "featurizer_id",
+    "feature_number",
+]
+
+# match the longest channel names first so that e.g. CL_488_1 is not read as CL
+_CHANNEL_TOKENS = sorted(
+    (tuple(channel.split("_")) for channel in CHANNELS), key=len, reverse=True
+)
+
+
+def _find_channels(tokens: list) -> list:
+    """
+    Find the channels in the tokens of a feature name, in order of appearance
+    """
+    channels = []
+    i = 0
+    while i < len(tokens):
+        for channel_tokens in _CHANNEL_TOKENS:
+            if tuple(tokens[i : i + len(channel_tokens)]) == channel_tokens:
+                channels.append("_".join(channel_tokens))
+                i += len(channel_tokens)
+                break
+        else:
+            i += 1
+    return channels
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_feature_name(feature: str) -> tuple:
+    """
+    Parse a single feature name into the FEATURE_INFO_COLUMNS values
+    """
+    tokens = feature.split("_")
+    featurizer_id = tokens[-1] if tokens[-1] in FEATURIZERS else None
+    if featurizer_id is not None:
+        tokens = tokens[:-1]
+
+    if featurizer_id == "scDINO":
+        # e.g. channel488-1_cls_feature_0_scDINO or channel_DNA_cls_feature_0_scDINO
+        channel_prefix = feature.split("_cls_")[0].removeprefix("channel")
+        channel = SCDINO_CHANNELS.get(channel_prefix.lstrip("_"), "None")
+        return (
+            "scDINO",
+            "scDINO",
+            "scDINO",
+            channel,
+            "None",
+            featurizer_id,
+            tokens[-1],
+        )
+
+    # e.g. Cells_Correlation_K_DNA_CL_488_1_CP
+    channels = _find_channels(tokens[2:])
+    return (
+        tokens[0],
+        tokens[1] if len(tokens) > 1 else None,
+        tokens[2] if len(tokens) > 2 else None,
+        channels[0] if len(channels) > 0 else "None",
+        channels[1] if len(channels) > 1 else "None",
+        featurizer_id,
+        None,
+    )
+
+
+def parse_feature_names(features: list) -> pd.DataFrame:
+    """
+    Parse CellProfiler and scDINO feature names into their compartment, feature
+    type, measurement, channels and featurizer.
+    Each unique feature name is only parsed once and the parsed names are cached,
+    so the result can be joined back onto long tables of e.g. model coefficients.
+
+    Parameters
+    ----------
+    features : list
+        The feature names to parse, duplicates are allowed
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per unique feature name, indexed by the feature name, with the
+        categorical FEATURE_INFO_COLUMNS. Features without a channel have the
+        "None" channel and Channel2 is only set for Correlation features.
+    """
+    features = pd.unique(pd.Series(features, dtype=object))
+    feature_info = pd.DataFrame(
+        [_parse_feature_name(feature) for feature in features],
+        index=pd.Index(features, name="feature"),
+        columns=FEATURE_INFO_COLUMNS,
+    )
+    return feature_info.astype("category")
@@ -0,0 +1,276 @@
+import collections
+import os
+import pathlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from copairs.compute import random_ap
+from statsmodels.stats.multitest import multipletests
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / ".cache" / "mAP_null_distributions"
+# about a thousand 1M sample null distributions
+DEFAULT_MAX_DISK_BYTES = 4 * 1024**3
+
+
+class NullDistributionCache:
+    """
+    Size-bounded in-memory and on-disk cache of the average precision null
+    distributions. A null distribution only depends on the number of positive
+    pairs, the total number of pairs, the null size and the seed, so it is
+    generated once, written atomically to a .npy file and memory-mapped by every
+    later mAP call, in any process. The seed of each null distribution is derived
+    from its key alone, so a cached file is identical no matter which call (or
+    process) generated it.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path, optional
+        The directory to store the .npy files in, by default DEFAULT_CACHE_DIR
+    max_memory_entries : int, optional
+        The number of memory-mapped null distributions to keep open before the
+        least recently used one is closed, by default 1024
+    max_disk_bytes : int, optional
+        The size of the on-disk cache before the least recently used files are
+        removed, by default DEFAULT_MAX_DISK_BYTES
+    n_workers : int, optional
+        The number of threads that generate the missing null distributions,
+        by default None (os.cpu_count())
+    """
+
+    def __init__(
+        self,
+        cache_dir: pathlib.Path = None,
+        max_memory_entries: int = 1024,
+        max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+        n_workers: int = None,
+    ):
+        self.cache_dir = pathlib.Path(
+            cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+        )
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self._memory_cache = collections.OrderedDict()
+        # the size of the cache as of the last scan plus the files written since,
+        # the directory is only scanned again once this exceeds max_disk_bytes
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+
+    def _cache_file_path(
+        self, num_pos: int, total: int, null_size: int, seed: int
+    ) -> pathlib.Path:
+        return (
+            self.cache_dir
+            / f"seed{seed}"
+            / f"ns{null_size}"
+            / f"n{total}_k{num_pos}.npy"
+        )
+
+    def get_null_dists(
+        self, null_confs: np.ndarray, null_size: int, seed: int
+    ) -> list[np.ndarray]:
+        """
+        Get the null distributions of the configurations. They are taken from the
+        memory-mapped files that are already open, then from disk, and the
+        missing ones are generated in parallel. The on-disk cache is only trimmed
+        afterwards and never removes the files of this call.
+
+        Parameters
+        ----------
+        null_confs : np.ndarray
+            The (number of positive pairs, total number of pairs) configurations
+        null_size : int
+            The number of samples in the null distribution
+        seed : int
+            Random seed for reproducibility
+
+        Returns
+        -------
+        list[np.ndarray]
+            The (read-only) null distribution of each configuration
+        """
+        keys = [
+            (int(num_pos), int(total), int(null_size), int(seed))
+            for num_pos, total in null_confs
+        ]
+        null_dists = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory_cache:
+                    self._memory_cache.move_to_end(key)
+                    null_dists[key] = self._memory_cache[key]
+        missing_keys = list(dict.fromkeys(x for x in keys if x not in null_dists))
+
+        written_bytes = 0
+        if len(missing_keys) > 0:
+            with ThreadPoolExecutor(
+                max_workers=min(self.n_workers, len(missing_keys))
+            ) as executor:
+                for key, (null_dist, n_bytes) in zip(
+                    missing_keys, executor.map(self._load_or_generate, missing_keys)
+                ):
+                    null_dists[key] = null_dist
+                    written_bytes += n_bytes
+            with self._lock:
+                for key in missing_keys:
+                    self._memory_cache[key] = null_dists[key]
+                while len(self._memory_cache) > self.max_memory_entries:
+                    self._memory_cache.popitem(last=False)
+        if written_bytes > 0:
+            self._trim_disk(written_bytes, {self._cache_file_path(*x) for x in keys})
+        return [null_dists[key] for key in keys]
+
+    def _load_or_generate(self, key: tuple) -> tuple[np.ndarray, int]:
+        """
+        Memory-map the null distribution of a key, generating and writing it if it
+        is not on disk, and return it with the number of bytes written
+        """
+        cache_file_path = self._cache_file_path(*key)
+        try:
+            # mark the file as recently used for the on-disk eviction
+            os.utime(cache_file_path)
+            return np.load(cache_file_path, mmap_mode="r"), 0
+        except FileNotFoundError:
+            # not cached yet, or removed by another process in the meantime
+            pass
+        num_pos, total, null_size, _ = key
+        conf_seed = np.random.SeedSequence(key).generate_state(1)[0]
+        null_dist = random_ap(null_size, num_pos, total, conf_seed)
+        n_bytes = self._write(cache_file_path, null_dist)
+        try:
+            # memory-map the written file so that the memory cache does not hold
+            # the generated array
+            return np.load(cache_file_path, mmap_mode="r"), n_bytes
+        except FileNotFoundError:
+            # evicted by another process since it was written
+            null_dist.setflags(write=False)
+            return null_dist, n_bytes
+
+    def _write(self, cache_file_path: pathlib.Path, null_dist: np.ndarray) -> int:
+        """
+        Atomically write a null distribution so that concurrent processes never
+        read a partially written file and return the size of the file
+        """
+        cache_file_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=cache_file_path.parent, suffix=".tmp", delete=False
+        ) as tmp_file:
+            np.save(tmp_file, null_dist)
+        os.replace(tmp_file.name, cache_file_path)
+        return os.path.getsize(cache_file_path)
+
+    def _trim_disk(self, written_bytes: int, protected_files: set) -> None:
+        """
+        Add the written bytes to the size of the on-disk cache and evict the least
+        recently used files once it exceeds max_disk_bytes
+        """
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk()[1]
+            else:
+                self._disk_bytes += written_bytes
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_from_disk(protected_files)
+
+    def _scan_disk(self) -> tuple[list, int]:
+        """
+        List the cached files from the least to the most recently used and sum
+        their size
+        """
+        cache_files = []
+        for cache_file in self.cache_dir.rglob("*.npy"):
+            try:
+                stat = cache_file.stat()
+            except FileNotFoundError:
+                # removed by another process during the scan
+                continue
+            cache_files.append((stat.st_mtime, stat.st_size, cache_file))
+        cache_files.sort(key=lambda cache_file: cache_file[0])
+        return cache_files, sum(size for _, size, _ in cache_files)
+
+    def _evict_from_disk(self, protected_files: set) -> None:
+        """
+        Remove the least recently used files, except the protected ones, until the
+        cache is below 80% of max_disk_bytes, so that the directory is not scanned
+        again on every write. Files that are already memory-mapped stay readable.
+        """
+        cache_files, self._disk_bytes = self._scan_disk()
+        for _, size, cache_file in cache_files:
+            if self._disk_bytes <= 0.8 * self.max_disk_bytes:
+                break
+            if cache_file in protected_files:
+                continue
+            cache_file.unlink(missing_ok=True)
+            self._disk_bytes -= size
+
+
+# shared by every mAP entry point in this process
+null_distribution_cache = NullDistributionCache()
+
+
+def mean_average_precision(
+    ap_scores: pd.DataFrame,
+    sameby: list,
+    null_size: int,
+    threshold: float,
+    seed: int,
+    cache: NullDistributionCache = None,
+) -> pd.DataFrame:
+    """
+    Calculate the mean average precision and p-values as
+    copairs.map.mean_average_precision does, with the null distributions taken
+    from a NullDistributionCache instead of the copairs cache_dir, so copairs
+    never generates or writes a null distribution itself
+
+    Parameters
+    ----------
+    ap_scores : pd.DataFrame
+        The average precision scores with the n_pos_pairs and n_total_pairs columns
+    sameby : list
+        The metadata columns used to group the profiles
+    null_size : int
+        The number of samples in the null distribution
+    threshold : float
+        The p-value threshold for significance
+    seed : int
+        Random seed for reproducibility
+    cache : NullDistributionCache, optional
+        The cache to use, by default None which uses the shared module cache
+
+    Returns
+    -------
+    pd.DataFrame
+        The mean average precision, p-value and corrected p-value of each group
+    """
+    cache = cache if cache is not None else null_distribution_cache
+    ap_scores = ap_scores.query("~average_precision.isna() and n_pos_pairs > 0")
+    ap_scores = ap_scores.reset_index(drop=True).copy()
+
+    null_confs, rev_ix = np.unique(
+        ap_scores[["n_pos_pairs", "n_total_pairs"]].values,
+        axis=0,
+        return_inverse=True,
+    )
+    rev_ix = rev_ix.ravel()
+    null_dists = cache.get_null_dists(null_confs, null_size, seed)
+    ap_scores["null_ix"] = rev_ix
+
+    map_scores = ap_scores.groupby(sameby, observed=True).agg(
+        {"average_precision": ["mean", lambda x: list(x.index)]}
+    )
+    map_scores.columns = ["mean_average_precision", "indices"]
+    # the null of a group is the mean of the nulls of its profiles, as in copairs
+    p_values = []
+    for map_score, indices in map_scores[["mean_average_precision", "indices"]].values:
+        null_dist = np.mean([null_dists[i] for i in rev_ix[indices]], axis=0)
+        p_values.append(((null_dist > map_score).sum() + 1) / (null_size + 1))
+    map_scores["p_value"] = p_values
+
+    _, pvals_corrected, _, _ = multipletests(map_scores["p_value"], method="fdr_bh")
+    map_scores["corrected_p_value"] = pvals_corrected
+    map_scores["below_p"] = map_scores["p_value"] < threshold
+    map_scores["below_corrected_p"] = map_scores["corrected_p_value"] < threshold
+    return map_scores
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+
+def shuffle_columns(
+    df: pd.DataFrame,
+    protected_columns: list = None,
+    seed: int | np.random.Generator = 0,
+) -> pd.DataFrame:
+    """
+    Independently permute the rows of every column of a dataframe to build a
+    shuffled baseline. The columns of each numpy dtype are permuted together as
+    one 2-D block instead of one column at a time.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The dataframe to shuffle
+    protected_columns : list, optional
+        The columns to keep in place, e.g. the metadata that the shuffled
+        baseline is grouped by, by default None (shuffle every column)
+    seed : int | np.random.Generator, optional
+        Random seed or generator for reproducibility, by default 0. Pass the same
+        generator to shuffle several dataframes with one seed.
+
+    Returns
+    -------
+    pd.DataFrame
+        The shuffled dataframe with the columns and index of df
+    """
+    rng = np.random.default_rng(seed)
+    protected_columns = set(protected_columns if protected_columns is not None else [])
+    columns_to_shuffle = [x for x in df.columns if x not in protected_columns]
+
+    # group the columns by dtype so that each block is a single contiguous array
+    columns_by_dtype = {}
+    for column, dtype in df[columns_to_shuffle].dtypes.items():
+        columns_by_dtype.setdefault(dtype, []).append(column)
+
+    blocks = []
+    for dtype, columns in columns_by_dtype.items():
+        if isinstance(dtype, np.dtype):
+            # selecting the columns already copies them, so the (column-major)
+            # block is permuted in place unless pandas hands out a read-only view
+            values = df[columns].to_numpy(dtype=dtype)
+            if not values.flags.writeable:
+                values = values.copy()
+            rng.permuted(values, axis=0, out=values)
+            blocks.append(
+                pd.DataFrame(values, index=df.index, columns=columns, copy=False)
+            )
+        else:
+            # extension dtypes (e.g. categorical) are taken column by column so
+            # that the dtype is kept
+            blocks.append(
+                pd.DataFrame(
+                    {
+                        column: df[column].iloc[rng.permutation(len(df))].to_numpy()
+                        for column in columns
+                    },
+                    index=df.index,
+                ).astype({column: dtype for column in columns})
+            )
+
+    if len(blocks) != 1:
+        protected_df = df[[x for x in df.columns if x in protected_columns]]
+        return pd.concat([protected_df, *blocks], axis=1)[df.columns]
+    # the protected columns are inserted into the single shuffled block in column
+    # order, concatenating would copy the block to consolidate it with them
+    shuffled_df = blocks[0]
+    for i, column in enumerate(df.columns):
+        if column in protected_columns:
+            shuffled_df.insert(i, column, df[column])
+    return shuffled_df
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import pandas as pd
+
+DEFAULT_CACHE_DIR = pathlib.Path.home() / ".cache" / "mAP_tasks"
+
+
+def file_fingerprint(*file_paths: pathlib.Path) -> str:
+    """
+    Fingerprint parquet files by their size and footer without reading the data.
+    The footer holds the schema, row group offsets and column statistics, so it
+    changes whenever the contents of the file change.
+
+    Parameters
+    ----------
+    *file_paths : pathlib.Path
+        The parquet files to fingerprint
+
+    Returns
+    -------
+    str
+        The hex digest of the files
+    """
+    file_hash = hashlib.sha256()
+    for file_path in file_paths:
+        with open(file_path, "rb") as parquet_file:
+            # a parquet file ends with the footer, its 4 byte length and "PAR1"
+            parquet_file.seek(-8, os.SEEK_END)
+            file_size = parquet_file.tell() + 8
+            footer_size = int.from_bytes(parquet_file.read(4), "little")
+            parquet_file.seek(-8 - footer_size, os.SEEK_END)
+            file_hash.update(str(file_size).encode())
+            file_hash.update(parquet_file.read(footer_size))
+    return file_hash.hexdigest()
+
+
+def task_key(**task_parameters) -> str:
+    """
+    Hash everything a task result depends on into its cache key
+
+    Parameters
+    ----------
+    **task_parameters
+        The JSON serializable inputs of the task, e.g. the input fingerprint,
+        feature columns, timepoint, shuffle flag, seed and mAP parameters
+
+    Returns
+    -------
+    str
+        The hex digest of the task parameters
+    """
+    return hashlib.sha256(
+        json.dumps(task_parameters, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class TaskCache:
+    """
+    Content-addressed on-disk cache of task result dataframes. A result is stored
+    under the key of its inputs (see task_key), so re-running an analysis only
+    computes the tasks whose inputs changed.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path, optional
+        The directory to store the results in, by default DEFAULT_CACHE_DIR
+    """
+
+    def __init__(self, cache_dir: pathlib.Path = None):
+        self.cache_dir = pathlib.Path(
+            cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+        )
+
+    def _cache_file_path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / key[:2] / f"{key}.parquet"
+
+    def __contains__(self, key: str) -> bool:
+        return self._cache_file_path(key).is_file()
+
+    def get(self, key: str) -> pd.DataFrame | None:
+        """
+        Get a cached result
+
+        Parameters
+        ----------
+        key : str
+            The key of the task
+
+        Returns
+        -------
+        pd.DataFrame | None
+            The result of the task, or None if it is not cached
+        """
+        cache_file_path = self._cache_file_path(key)
+        if not cache_file_path.is_file():
+            return None
+        return pd.read_parquet(cache_file_path)
+
+    def put(self, key: str, result_df: pd.DataFrame) -> None:
+        """
+        Atomically store a result so that concurrent processes never read a
+        partially written file
+
+        Parameters
+        ----------
+        key : str
+            The key of the task
+        result_df : pd.DataFrame
+            The result of the task
+        """
+        cache_file_path = self._cache_file_path(key)
+        cache_file_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=cache_file_path.parent, suffix=".parquet", delete=False
+        ) as tmp_file:
+            result_df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file.name, cache_file_path)